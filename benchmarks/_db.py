@@ -0,0 +1,20 @@
+# Database helpers for benchmarks that seed tables
+# These empty the tables they seed, so they refuse to run against anything
+# but a scratch database
+import sys
+
+from polarity.utils import Base, get_db_engine
+
+
+def check_scratch_database() -> None:
+    database = get_db_engine().url.database
+    if "bench" not in database:
+        sys.exit(
+            "Refusing to empty tables in {}, DATABASE_URL must name a ".format(database)
+            + "database for benchmarks"
+        )
+
+
+async def create_tables() -> None:
+    async with get_db_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,214 @@
+# End to end throughput of announcement runs
+# Runs lost_sector_announcer, xur_announcer and xur_rectify_announcement
+# against benchmarks.fake_discord, with subscriber tables of growing size,
+# and reports time to first and last post, requests made, 429s and peak
+# memory. Google Sheets is replaced by a fake rotation that blocks for
+# SHEETS_LATENCY seconds, like the synchronous gspread fetch does.
+#
+# DATABASE_URL must point at a scratch Postgres database whose name contains
+# "bench", its subscription tables are emptied and reseeded for every size.
+# Sends are paced by the REST lanes at REST_GLOBAL_RATE a second, so the
+# largest sizes take a while.
+# Run with: python -m benchmarks.bench_announce [channels ...] [--webhooks share]
+
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import types
+
+os.environ.setdefault("DELIVERY_COALESCE_WINDOW", "0")
+os.environ.setdefault("CORRECTION_DEBOUNCE", "0")
+# Read the sheet on every lost sector run, as a reset usually does
+os.environ.setdefault("ROTATION_CACHE_TTL", "0")
+
+from . import _env  # noqa: F401
+
+import aiohttp
+import hikari
+from sqlalchemy import insert, text
+
+from polarity import autoannounce, cfg, controller, user_commands
+from polarity.delivery_worker import _RESTOnlyBot
+from polarity.schemas import (
+    AutopostSubscription,
+    Feed,
+    LostSectorPostSettings,
+    XurPostSettings,
+)
+from polarity.utils import db_session
+
+from . import fake_discord
+from ._db import check_scratch_database, create_tables
+
+PORT = 8765
+FAKE_URL = "http://127.0.0.1:{}".format(PORT)
+ORIGIN = FAKE_URL + "/origin"
+SHEETS_LATENCY = 0.5
+SIZES = [1_000, 10_000, 100_000]
+# Far from any real snowflake, so seeded channels are easy to tell apart
+FIRST_CHANNEL_ID = 10**17
+
+
+class _FakeRotation:
+    # Stands in for sector_accounting.Rotation, which reads Google Sheets
+    name = "The Conflux"
+    reward = "Exotic Leg Armor"
+    champions = "Barrier, Overload"
+    shields = "Arc, Void"
+    burn = "Solar"
+    modifiers = "Epitaph, Chaff"
+    shortlink_gfx = ORIGIN + "/ls"
+
+    @classmethod
+    def from_gspread_url(cls, url, credentials, buffer=0):
+        # Blocks its thread, as gspread does
+        time.sleep(SHEETS_LATENCY)
+        return cls
+
+
+class _BenchBot(_RESTOnlyBot):
+    def dispatch(self, event) -> None:
+        pass
+
+
+class _BenchContext:
+    # Just what xur_rectify_announcement needs from a lightbulb.Context
+    def __init__(self, bot: _BenchBot, **options):
+        self.bot = bot
+        self.options = types.SimpleNamespace(**options)
+
+    async def respond(self, *args, **kwargs) -> None:
+        pass
+
+    async def edit_last_response(self, *args, **kwargs) -> None:
+        pass
+
+
+async def seed(channels: int, webhook_share: float) -> None:
+    """Empty the tables and subscribe channels to every feed"""
+    await create_tables()
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                text(
+                    "TRUNCATE autopostsubscription, deliveryjob, deliverybatch, "
+                    + "deliveryrun, xurpostsettings, lostsectorpostsettings"
+                )
+            )
+            session.add(LostSectorPostSettings(0))
+            session.add(XurPostSettings(0, ORIGIN + "/xur", ORIGIN + "/xurpost"))
+            webhooks = int(channels * webhook_share)
+            rows = [
+                {
+                    "id": FIRST_CHANNEL_ID + i,
+                    "server_id": FIRST_CHANNEL_ID + i,
+                    "feeds": int(Feed.LOST_SECTOR | Feed.XUR),
+                    "failure_count": 0,
+                    # The fake takes webhook ids to be their channel's id
+                    "webhook_id": FIRST_CHANNEL_ID + i if i < webhooks else None,
+                    "webhook_token": "token" if i < webhooks else None,
+                }
+                for i in range(channels)
+            ]
+            for start in range(0, len(rows), 10_000):
+                await session.execute(
+                    insert(AutopostSubscription), rows[start : start + 10_000]
+                )
+
+
+async def _fake_stats(session: aiohttp.ClientSession, reset: bool = False) -> dict:
+    if reset:
+        async with session.post(FAKE_URL + "/_reset") as resp:
+            resp.raise_for_status()
+        return {}
+    async with session.get(FAKE_URL + "/_stats") as resp:
+        return await resp.json()
+
+
+async def run_scenario(session: aiohttp.ClientSession, name: str, coro) -> dict:
+    await _fake_stats(session, reset=True)
+    start = time.time()
+    await coro
+    end = time.time()
+    stats = await _fake_stats(session)
+    return {
+        "scenario": name,
+        "first_post": (stats["first_post"] or end) - start,
+        "last_post": (stats["last_post"] or end) - start,
+        "total": end - start,
+        "requests": stats["total_requests"],
+        "rate_limited": stats["rate_limited"],
+        # Peak for the process so far, kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+async def bench(sizes, webhook_share: float) -> None:
+    check_scratch_database()
+    user_commands.Rotation = _FakeRotation
+    rest = hikari.RESTApp(url=FAKE_URL + fake_discord.API)
+    print(
+        "{:>8} {:<16} {:>12} {:>12} {:>10} {:>9} {:>6} {:>9}".format(
+            "channels",
+            "scenario",
+            "first post",
+            "last post",
+            "total",
+            "requests",
+            "429s",
+            "peak MB",
+        )
+    )
+    async with aiohttp.ClientSession() as session:
+        async with rest.acquire(cfg.main_token, hikari.TokenType.BOT) as client:
+            bot = _BenchBot(client, await client.fetch_my_user())
+            for channels in sizes:
+                await seed(channels, webhook_share)
+                lost_sector = autoannounce.LostSectorSignal(bot)
+                lost_sector.reset_at = time.monotonic()
+                xur = autoannounce.XurSignal(bot)
+                xur.reset_at = time.monotonic()
+                ctx = _BenchContext(bot, change="Benchmark correction", force=False)
+                for name, coro in [
+                    ("lost sector", autoannounce.lost_sector_announcer(lost_sector)),
+                    ("xur", autoannounce.xur_announcer(xur)),
+                    (
+                        "xur correction",
+                        controller.xur_rectify_announcement.callback(ctx),
+                    ),
+                ]:
+                    result = await run_scenario(session, name, coro)
+                    print(
+                        "{channels:>8} {scenario:<16} {first_post:>11.2f}s "
+                        "{last_post:>11.2f}s {total:>9.2f}s {requests:>9} "
+                        "{rate_limited:>6} {peak_rss_mb:>9.1f}".format(
+                            channels=channels, **result
+                        )
+                    )
+
+
+def main(argv) -> None:
+    webhook_share = 0.0
+    if "--webhooks" in argv:
+        index = argv.index("--webhooks")
+        webhook_share = float(argv[index + 1])
+        del argv[index : index + 2]
+    sizes = [int(arg) for arg in argv] or SIZES
+
+    server = multiprocessing.Process(
+        target=fake_discord.serve, args=(PORT,), daemon=True
+    )
+    server.start()
+    # Give the fake a moment to start listening
+    time.sleep(1)
+    try:
+        asyncio.run(bench(sizes, webhook_share))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,185 @@
+# Database scale of the bot's query patterns
+# Seeds the subscription, settings and commands tables at growing sizes and
+# times the queries the bot actually makes against them, calling the bot's own
+# functions for them, so schema and query changes can be checked for scaling
+# regressions.
+#
+# DATABASE_URL must point at a scratch Postgres database whose name contains
+# "bench", the seeded tables are emptied for every size.
+# Run with: python -m benchmarks.bench_db [subscriptions ...]
+
+import asyncio
+import random
+import statistics
+import sys
+import time
+
+from . import _env  # noqa: F401
+
+from sqlalchemy import insert, text
+
+from polarity.controller import _xur_subscriptions
+from polarity.delivery import (
+    _record_delivered,
+    _record_transient_failure,
+    _subscribers,
+)
+from polarity.schemas import (
+    AutopostSubscription,
+    Commands,
+    Feed,
+    LostSectorPostSettings,
+    XurPostSettings,
+)
+from polarity.user_commands import _command_names
+from polarity.utils import _create_or_get, db_session
+
+from ._db import check_scratch_database, create_tables
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# Custom commands grow much slower than subscriptions
+COMMANDS_PER_SUBSCRIPTION = 0.01
+# Times each query is run for every size
+REPEATS = 50
+FIRST_CHANNEL_ID = 10**17
+
+
+async def seed(subscriptions: int) -> None:
+    """Empty and fill the tables, with a realistic mix of feeds"""
+    await create_tables()
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                text(
+                    "TRUNCATE autopostsubscription, commands, "
+                    + "xurpostsettings, lostsectorpostsettings"
+                )
+            )
+            session.add(LostSectorPostSettings(0))
+            session.add(XurPostSettings(0))
+    rng = random.Random(0)
+    for start in range(0, subscriptions, 10_000):
+        rows = [
+            {
+                "id": FIRST_CHANNEL_ID + i,
+                "server_id": FIRST_CHANNEL_ID + i // 3,
+                # Some channels have unsubscribed from everything
+                "feeds": rng.choice([0, 1, 2, 3, 3, 3]),
+                "xur_msg_id": FIRST_CHANNEL_ID + i,
+                "failure_count": 0,
+            }
+            for i in range(start, min(start + 10_000, subscriptions))
+        ]
+        async with db_session() as session:
+            async with session.begin():
+                await session.execute(insert(AutopostSubscription), rows)
+    commands = max(10, int(subscriptions * COMMANDS_PER_SUBSCRIPTION))
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                insert(Commands),
+                [
+                    {
+                        "name": "command{}".format(i),
+                        "description": "Benchmark command",
+                        "response": "https://example.com/{}".format(i),
+                    }
+                    for i in range(commands)
+                ],
+            )
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(text("ANALYZE"))
+
+
+async def announcer_scan(channel_id: int, command_name: str) -> None:
+    # delivery.DeliveryCoalescer._deliver_batch
+    await _subscribers(Feed.LOST_SECTOR | Feed.XUR)
+
+
+async def correction_scan(channel_id: int, command_name: str) -> None:
+    # controller.xur_rectify_announcement, loads full rows
+    async with db_session() as session:
+        async with session.begin():
+            await _xur_subscriptions(session)
+
+
+async def delivered_update(channel_id: int, command_name: str) -> None:
+    # delivery._send_embeds_if_textable_channel, once per channel
+    await _record_delivered(channel_id, {Feed.XUR.msg_id_column: channel_id})
+
+
+async def transient_failure(channel_id: int, command_name: str) -> None:
+    # delivery._attempt_delivery, once per channel given up on
+    await _record_transient_failure(channel_id)
+
+
+async def create_or_get(channel_id: int, command_name: str) -> None:
+    # The announcement signals, every reset
+    await _create_or_get(XurPostSettings, 0)
+
+
+async def add_name_check(channel_id: int, command_name: str) -> bool:
+    # user_commands.add_command
+    async with db_session() as session:
+        async with session.begin():
+            return command_name in await _command_names(session)
+
+
+async def command_lookup(channel_id: int, command_name: str) -> None:
+    # user_commands.edit_command
+    async with db_session() as session:
+        async with session.begin():
+            await session.get(Commands, command_name)
+
+
+QUERIES = [
+    ("announcer scan", announcer_scan),
+    ("correction scan", correction_scan),
+    ("delivered update", delivered_update),
+    ("transient failure", transient_failure),
+    ("_create_or_get", create_or_get),
+    ("/add name check", add_name_check),
+    ("command lookup", command_lookup),
+]
+
+
+async def bench(sizes) -> None:
+    check_scratch_database()
+    print(
+        "{:>9} {:<20} {:>10} {:>10} {:>10}".format(
+            "rows", "query", "median", "p95", "max"
+        )
+    )
+    for size in sizes:
+        await seed(size)
+        commands = max(10, int(size * COMMANDS_PER_SUBSCRIPTION))
+        rng = random.Random(1)
+        for name, query in QUERIES:
+            # Warm up the pool and the statement cache
+            await query(FIRST_CHANNEL_ID, "command0")
+            timings = []
+            for _ in range(REPEATS):
+                channel_id = FIRST_CHANNEL_ID + rng.randrange(size)
+                command_name = "command{}".format(rng.randrange(commands))
+                start = time.perf_counter()
+                await query(channel_id, command_name)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(
+                "{:>9} {:<20} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms".format(
+                    size,
+                    name,
+                    statistics.median(timings),
+                    timings[int(len(timings) * 0.95) - 1],
+                    timings[-1],
+                )
+            )
+
+
+def main(argv) -> None:
+    asyncio.run(bench([int(arg) for arg in argv] or SIZES))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
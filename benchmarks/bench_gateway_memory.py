@@ -0,0 +1,311 @@
+# Memory held by the gateway cache per guild
+# Builds the bot with hikari's defaults (all unprivileged intents and every
+# cache component) and with the intents and cache components from cfg, then
+# feeds each synthetic GUILD_CREATE payloads, shaped like a mid sized
+# community server, and some message traffic for the intents that receive
+# it. Reports memory allocated (tracemalloc) and resident set growth per
+# 1k guilds. Each configuration runs in its own process so that one doesn't
+# inflate the other's RSS.
+# Run with: python -m benchmarks.bench_gateway_memory [guilds ...]
+
+import asyncio
+import multiprocessing
+import sys
+import tracemalloc
+import types
+
+from . import _env  # noqa: F401
+
+import hikari
+import lightbulb
+
+from polarity import cfg
+
+SIZES = [1_000, 5_000]
+# Per synthetic guild
+CHANNELS = 30
+ROLES = 20
+EMOJIS = 25
+MEMBERS = 10
+VOICE_STATES = 3
+PRESENCES = 10
+MESSAGES = 20
+# Snowflakes far from any real ones
+FIRST_ID = 10**17
+TIMESTAMP = "2022-01-01T00:00:00+00:00"
+
+
+def _user(user_id: int) -> dict:
+    return {
+        "id": str(user_id),
+        "username": "user{}".format(user_id % 100_000),
+        "discriminator": "0001",
+        "avatar": None,
+        "bot": False,
+        "public_flags": 0,
+    }
+
+
+def _member(user_id: int, role_ids) -> dict:
+    return {
+        "user": _user(user_id),
+        "nick": None,
+        "avatar": None,
+        "roles": [str(role_id) for role_id in role_ids],
+        "joined_at": TIMESTAMP,
+        "premium_since": None,
+        "deaf": False,
+        "mute": False,
+        "pending": False,
+        "communication_disabled_until": None,
+    }
+
+
+def _guild(index: int, intents: hikari.Intents) -> dict:
+    """A GUILD_CREATE payload with only what intents would have Discord send"""
+    guild_id = FIRST_ID + index * 1_000
+    channel_ids = [guild_id + 1 + i for i in range(CHANNELS)]
+    role_ids = [guild_id + 100 + i for i in range(ROLES)]
+    user_ids = [guild_id + 200 + i for i in range(MEMBERS)]
+    payload = {
+        "id": str(guild_id),
+        "name": "Guild {}".format(index),
+        "icon": None,
+        "splash": None,
+        "discovery_splash": None,
+        "banner": None,
+        "description": None,
+        "owner_id": str(user_ids[0]),
+        "afk_channel_id": None,
+        "afk_timeout": 300,
+        "verification_level": 1,
+        "default_message_notifications": 1,
+        "explicit_content_filter": 2,
+        "features": ["COMMUNITY", "NEWS"],
+        "mfa_level": 0,
+        "application_id": None,
+        "system_channel_id": str(channel_ids[0]),
+        "system_channel_flags": 0,
+        "rules_channel_id": str(channel_ids[1]),
+        "public_updates_channel_id": str(channel_ids[2]),
+        "joined_at": TIMESTAMP,
+        "large": True,
+        "unavailable": False,
+        "member_count": 5_000,
+        "max_members": 500_000,
+        "max_presences": None,
+        "max_video_channel_users": 25,
+        "vanity_url_code": None,
+        "premium_tier": 1,
+        "premium_subscription_count": 3,
+        "preferred_locale": "en-US",
+        "nsfw_level": 0,
+        "premium_progress_bar_enabled": False,
+        "roles": [
+            {
+                "id": str(role_id),
+                "name": "Role {}".format(i),
+                "color": 0,
+                "hoist": False,
+                "icon": None,
+                "unicode_emoji": None,
+                "position": i,
+                "permissions": str(int(hikari.Permissions.SEND_MESSAGES)),
+                "managed": False,
+                "mentionable": False,
+            }
+            for i, role_id in enumerate([guild_id] + role_ids[1:])
+        ],
+        "channels": [
+            {
+                "id": str(channel_id),
+                "type": 0,
+                "name": "channel-{}".format(i),
+                "position": i,
+                "permission_overwrites": [
+                    {
+                        "id": str(role_ids[1]),
+                        "type": 0,
+                        "allow": "0",
+                        "deny": str(int(hikari.Permissions.SEND_MESSAGES)),
+                    }
+                ],
+                "nsfw": False,
+                "parent_id": None,
+                "topic": "Topic of channel {}".format(i),
+                "last_message_id": None,
+                "rate_limit_per_user": 0,
+            }
+            for i, channel_id in enumerate(channel_ids)
+        ],
+        "threads": [],
+        "stickers": [],
+        "stage_instances": [],
+        "guild_scheduled_events": [],
+        "emojis": [
+            {
+                "id": str(guild_id + 500 + i),
+                "name": "emoji{}".format(i),
+                "roles": [],
+                "require_colons": True,
+                "managed": False,
+                "animated": False,
+                "available": True,
+            }
+            for i in range(EMOJIS)
+        ],
+        # Discord sends the members in voice and the bot's own member
+        "members": [_member(user_id, role_ids[1:3]) for user_id in user_ids],
+        "voice_states": [],
+        "presences": [],
+    }
+    if intents & hikari.Intents.GUILD_VOICE_STATES:
+        payload["voice_states"] = [
+            {
+                "channel_id": str(channel_ids[-1]),
+                "user_id": str(user_id),
+                "session_id": "session{}".format(user_id),
+                "deaf": False,
+                "mute": False,
+                "self_deaf": False,
+                "self_mute": False,
+                "self_stream": False,
+                "self_video": False,
+                "suppress": False,
+                "request_to_speak_timestamp": None,
+            }
+            for user_id in user_ids[:VOICE_STATES]
+        ]
+    if intents & hikari.Intents.GUILD_PRESENCES:
+        payload["presences"] = [
+            {
+                "user": {"id": str(user_id)},
+                "status": "online",
+                "activities": [],
+                "client_status": {"desktop": "online"},
+            }
+            for user_id in user_ids[:PRESENCES]
+        ]
+    return payload
+
+
+def _message(index: int, number: int) -> dict:
+    guild_id = FIRST_ID + index * 1_000
+    user_id = guild_id + 200 + number % MEMBERS
+    return {
+        "id": str(guild_id + 600 + number),
+        "channel_id": str(guild_id + 1 + number % CHANNELS),
+        "guild_id": str(guild_id),
+        "author": _user(user_id),
+        "member": {
+            key: value for key, value in _member(user_id, []).items() if key != "user"
+        },
+        "content": "Message {} in the channel".format(number),
+        "timestamp": TIMESTAMP,
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0,
+        "flags": 0,
+    }
+
+
+async def _feed(bot: lightbulb.BotApp, guilds: int) -> None:
+    shard = types.SimpleNamespace(id=0, intents=bot.intents)
+    for index in range(guilds):
+        bot.event_manager.consume_raw_event(
+            "GUILD_CREATE", shard, _guild(index, bot.intents)
+        )
+        if bot.intents & hikari.Intents.GUILD_MESSAGES:
+            for number in range(MESSAGES):
+                bot.event_manager.consume_raw_event(
+                    "MESSAGE_CREATE", shard, _message(index, number)
+                )
+        if index % 100 == 99:
+            await _drain()
+    await _drain()
+
+
+async def _drain() -> None:
+    # Events are consumed in tasks, wait for all of them to finish
+    current = asyncio.current_task()
+    while pending := [task for task in asyncio.all_tasks() if task is not current]:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _rss() -> int:
+    # Current resident set size in bytes, on linux
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * 4096
+
+
+def _measure(lean: bool, guilds: int, results) -> None:
+    if lean:
+        bot = lightbulb.BotApp(**cfg.lightbulb_params)
+    else:
+        bot = lightbulb.BotApp(token=cfg.main_token, logs=None)
+    rss_before = _rss()
+    tracemalloc.start()
+    asyncio.run(_feed(bot, guilds))
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results.put(
+        {
+            "allocated": allocated,
+            "rss": _rss() - rss_before,
+            "cached_guilds": len(bot.cache.get_guilds_view()),
+            "cached_members": sum(
+                len(members) for members in bot.cache.get_members_view().values()
+            ),
+            "cached_messages": len(bot.cache.get_messages_view()),
+        }
+    )
+
+
+def bench(sizes) -> None:
+    print("Lean intents: {!r}".format(cfg.gateway_intents))
+    print("Lean cache: {!r}".format(cfg.cache_components))
+    print(
+        "{:>7} {:<8} {:>14} {:>14} {:>9} {:>9} {:>9}".format(
+            "guilds",
+            "config",
+            "traced/1k MB",
+            "RSS/1k MB",
+            "guilds",
+            "members",
+            "messages",
+        )
+    )
+    context = multiprocessing.get_context("spawn")
+    for guilds in sizes:
+        for name, lean in [("default", False), ("cfg", True)]:
+            results = context.Queue()
+            process = context.Process(target=_measure, args=(lean, guilds, results))
+            process.start()
+            result = results.get()
+            process.join()
+            per_1k = 1_000 / guilds / 2**20
+            print(
+                "{:>7} {:<8} {:>14.2f} {:>14.2f} {:>9} {:>9} {:>9}".format(
+                    guilds,
+                    name,
+                    result["allocated"] * per_1k,
+                    result["rss"] * per_1k,
+                    result["cached_guilds"],
+                    result["cached_members"],
+                    result["cached_messages"],
+                )
+            )
+
+
+def main(argv) -> None:
+    bench([int(arg) for arg in argv] or SIZES)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+# CPU cost of announcement sends
+# Sends announcement embeds through hikari's create_message and
+# execute_webhook against benchmarks.fake_discord, run in its own process
+# with no latency or rate limits so only this process's CPU time is
+# counted. Alongside, times the parts of a send that depend on the embeds,
+# serializing them and deserializing the message discord returns, which
+# is the most that encoding the body once per run would save.
+# Run with: python -m benchmarks.bench_payload [sends]
+
+import asyncio
+import multiprocessing
+import sys
+import time
+from typing import List
+
+from . import _env  # noqa: F401
+
+import hikari
+
+from polarity import cfg
+from polarity.delivery_worker import _RESTOnlyBot
+
+from . import fake_discord
+
+PORT = 8766
+FAKE_URL = "http://127.0.0.1:{}".format(PORT)
+CHANNEL_ID = 10**17
+
+
+def _embeds():
+    # Shaped like the lost sector and xur announcement embeds
+    return [
+        hikari.Embed(
+            title="**Daily Lost Sector for October 19**",
+            description="<:LS:849727805994565662> **Sector**:\n\n" + "• Line\n" * 6,
+            color=cfg.kyber_pink,
+        ).set_image("https://example.com/ls.png"),
+        hikari.Embed(
+            title="Xur's Inventory and Location",
+            url="https://example.com/xurpost",
+            description="**Arrives:** Friday, October 16\n**Departs:** Tuesday",
+            color=cfg.kyber_pink,
+        )
+        .set_image("https://example.com/xur.png")
+        .set_footer("Correction"),
+    ]
+
+
+async def channel_sends(bot, embeds: List[hikari.Embed], sends: int) -> float:
+    start = time.process_time()
+    for _ in range(sends):
+        await bot.rest.create_message(CHANNEL_ID, embeds=embeds)
+    return time.process_time() - start
+
+
+async def webhook_sends(bot, embeds: List[hikari.Embed], sends: int) -> float:
+    start = time.process_time()
+    for _ in range(sends):
+        await bot.rest.execute_webhook(CHANNEL_ID, "token", embeds=embeds)
+    return time.process_time() - start
+
+
+async def embed_serialization(bot, embeds: List[hikari.Embed], sends: int) -> float:
+    start = time.process_time()
+    for _ in range(sends):
+        [bot.entity_factory.serialize_embed(embed) for embed in embeds]
+    return time.process_time() - start
+
+
+async def response_deserialization(bot, embeds: List[hikari.Embed], sends: int):
+    payload = fake_discord.FakeDiscord()._message(
+        1,
+        CHANNEL_ID,
+        [bot.entity_factory.serialize_embed(embed)[0] for embed in embeds],
+    )
+    start = time.process_time()
+    for _ in range(sends):
+        bot.entity_factory.deserialize_message(payload)
+    return time.process_time() - start
+
+
+async def bench(sends: int) -> None:
+    rest = hikari.RESTApp(url=FAKE_URL + fake_discord.API)
+    async with rest.acquire(cfg.main_token, hikari.TokenType.BOT) as client:
+        bot = _RESTOnlyBot(client, await client.fetch_my_user())
+        embeds = _embeds()
+        for name, case in [
+            ("create_message", channel_sends),
+            ("execute_webhook", webhook_sends),
+            ("  serialize embeds", embed_serialization),
+            ("  deserialize response", response_deserialization),
+        ]:
+            # Warm up
+            await case(bot, embeds, min(100, sends))
+            elapsed = await case(bot, embeds, sends)
+            print(
+                "{:<24} {:8.2f} ms CPU per 1000 sends".format(
+                    name, elapsed / sends * 1000 * 1000
+                )
+            )
+
+
+def main(sends: int = 5_000) -> None:
+    unlimited = fake_discord.FakeDiscordSettings(
+        latency=0, jitter=0, global_limit=10**9, route_limit=10**9
+    )
+    server = multiprocessing.Process(
+        target=fake_discord.serve, args=(PORT, unlimited), daemon=True
+    )
+    server.start()
+    # Give the fake a moment to start listening
+    time.sleep(1)
+    try:
+        asyncio.run(bench(sends))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
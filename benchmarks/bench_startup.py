@@ -0,0 +1,175 @@
+# Cold start of the bot, phase by phase
+# Times importing polarity.main module by module in a fresh interpreter,
+# building the bot and registering its commands, creating the db engine and
+# opening its first connection, then the startup warm up (custom commands,
+# settings and the lost sector rotation) with its steps run one after
+# another and run concurrently as warmup.warm_up does. The pool and the
+# rotation cache are emptied before every warm up, so each starts cold.
+# Google Sheets is replaced by a fake rotation that takes SHEETS_LATENCY
+# seconds to read.
+#
+# DATABASE_URL must point at a scratch Postgres database whose name contains
+# "bench", its commands table is emptied and reseeded.
+# Run with: python -m benchmarks.bench_startup [custom commands]
+
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+from . import _env  # noqa: F401
+
+import lightbulb
+from sqlalchemy import insert, text
+
+from polarity import cfg, controller, user_commands, utils, warmup
+from polarity.schemas import Commands
+
+from ._db import check_scratch_database, create_tables
+
+SHEETS_LATENCY = 1.0
+COMMANDS = 50
+# Times each warm up is run
+REPEATS = 5
+# Imported in this order, each is timed without what came before it
+IMPORT_STEPS = [
+    "hikari",
+    "lightbulb",
+    "sqlalchemy.ext.asyncio",
+    "sector_accounting",
+    "polarity.cfg",
+    "polarity.utils",
+    "polarity.schemas",
+    "polarity.user_commands",
+    "polarity.delivery",
+    "polarity.autoannounce",
+    "polarity.controller",
+    "polarity.main",
+]
+_IMPORT_SCRIPT = """
+import importlib, json, sys, time
+from benchmarks import _env
+timings = []
+for name in sys.argv[1:]:
+    start = time.perf_counter()
+    importlib.import_module(name)
+    timings.append((name, time.perf_counter() - start))
+print(json.dumps(timings))
+"""
+
+
+class _FakeRotation:
+    # Stands in for sector_accounting.Rotation, which reads Google Sheets
+    @classmethod
+    def from_gspread_url(cls, url, credentials, buffer=0):
+        time.sleep(SHEETS_LATENCY)
+        return cls
+
+
+def _report(phase: str, seconds: float) -> None:
+    print("{:<40} {:>9.3f}s".format(phase, seconds))
+
+
+def time_imports() -> None:
+    result = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT, *IMPORT_STEPS],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    timings = json.loads(result.stdout.splitlines()[-1])
+    for name, seconds in timings:
+        _report("import " + name, seconds)
+    _report("import total", sum(seconds for _, seconds in timings))
+
+
+def _build_bot() -> lightbulb.BotApp:
+    bot = lightbulb.BotApp(**cfg.lightbulb_params)
+    user_commands.register_all(bot)
+    controller.register_all(bot)
+    return bot
+
+
+async def seed(commands: int) -> None:
+    """Empty and fill the commands table"""
+    await create_tables()
+    async with utils.db_session() as session:
+        async with session.begin():
+            await session.execute(text("TRUNCATE commands"))
+            await session.execute(
+                insert(Commands),
+                [
+                    {
+                        "name": "command{}".format(i),
+                        "description": "Benchmark command",
+                        "response": "https://example.com/{}".format(i),
+                    }
+                    for i in range(commands)
+                ],
+            )
+
+
+async def _cold() -> types.SimpleNamespace:
+    """A StartingEvent for a new bot, with an empty pool and rotation cache"""
+    await utils.get_db_engine().dispose()
+    user_commands.command_index.clear()
+    user_commands.command_registry.clear()
+    user_commands.rotation_cache._rotation = None
+    return types.SimpleNamespace(app=_build_bot())
+
+
+async def _serial_warm_up() -> None:
+    event = await _cold()
+    await user_commands.register_commands_on_startup(event)
+    await warmup._load_settings()
+    await user_commands.rotation_cache.get()
+
+
+async def _concurrent_warm_up() -> None:
+    await warmup.warm_up(await _cold())
+
+
+async def bench(commands: int) -> None:
+    start = time.perf_counter()
+    _build_bot()
+    _report("bot and command registration", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    engine = utils.get_db_engine()
+    _report("db engine", time.perf_counter() - start)
+    start = time.perf_counter()
+    async with engine.connect():
+        pass
+    _report("first db connection", time.perf_counter() - start)
+
+    check_scratch_database()
+    await seed(commands)
+    user_commands.Rotation = _FakeRotation
+    for name, warm_up in [
+        ("warm up, one step after another", _serial_warm_up),
+        ("warm up, concurrent", _concurrent_warm_up),
+    ]:
+        timings = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            await warm_up()
+            timings.append(time.perf_counter() - start)
+        _report(name, statistics.median(timings))
+    # Steps of the last concurrent warm up
+    for phase, seconds in warmup.phases.items():
+        _report("  " + phase, seconds)
+
+
+def main(argv) -> None:
+    print("{:<40} {:>10}".format("phase", "time"))
+    time_imports()
+    asyncio.run(bench(int(argv[0]) if argv else COMMANDS))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,324 @@
+# Local stand-in for the Discord REST API and the kyber3000.com origin
+# Serves just the routes the announcers and corrections use. It models
+# Discord's per route buckets and global limit with real 429 responses and
+# rate limit headers, adds latency to every request, and can inject random
+# 429s. It also serves shortlinks that redirect to infographics, like the
+# kyber3000.com origin does. Request counts and post times are kept for the
+# benchmarks and served at /_stats.
+# Run on its own with: python -m benchmarks.fake_discord [port]
+
+import asyncio
+import collections
+import dataclasses
+import datetime as dt
+import itertools
+import random
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+API = "/api/v10"
+# A 1x1 png, served as every infographic
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082"
+)
+
+
+@dataclasses.dataclass
+class FakeDiscordSettings:
+    # Seconds added to every API request, plus up to jitter more
+    latency: float = 0.05
+    jitter: float = 0.05
+    # Requests per second across the bot's authenticated requests
+    global_limit: int = 50
+    # Requests per bucket window for each channel or webhook route
+    route_limit: int = 5
+    route_window: float = 5.0
+    # Share of requests answered with a 429 regardless of limits
+    random_429_rate: float = 0.0
+
+
+class _Bucket:
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = time.monotonic() + window
+
+    def take(self) -> Optional[float]:
+        """Use up a request, returns seconds to retry after if none are left"""
+        now = time.monotonic()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+        if self.remaining == 0:
+            return self.reset_at - now
+        self.remaining -= 1
+        return None
+
+
+class FakeDiscord:
+    def __init__(self, settings: FakeDiscordSettings = FakeDiscordSettings()):
+        self.settings = settings
+        self._ids = itertools.count(int(time.time() * 1000 - 1420070400000) << 22)
+        # Message id -> (channel id, embeds), kept across resets so that
+        # corrections can edit the posts of an earlier run
+        self.messages: Dict[int, Tuple[int, List[dict]]] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        """Start counting requests and posts afresh"""
+        self.requests: Dict[str, int] = collections.Counter()
+        self.rate_limited = 0
+        self.first_post: Optional[float] = None
+        self.last_post: Optional[float] = None
+        self.started = time.time()
+        self._global = _Bucket(self.settings.global_limit, 1.0)
+        self._buckets: Dict[Tuple[str, str], _Bucket] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._limits])
+        app.add_routes(
+            [
+                web.get(API + "/users/@me", self.get_me),
+                web.get(API + "/channels/{channel}", self.get_channel),
+                web.post(API + "/channels/{channel}/messages", self.create_message),
+                web.get(
+                    API + "/channels/{channel}/messages/{message}", self.get_message
+                ),
+                web.patch(
+                    API + "/channels/{channel}/messages/{message}", self.edit_message
+                ),
+                web.post(
+                    API + "/channels/{channel}/messages/{message}/crosspost",
+                    self.get_message,
+                ),
+                web.post(API + "/webhooks/{webhook}/{token}", self.execute_webhook),
+                web.get(
+                    API + "/webhooks/{webhook}/{token}/messages/{message}",
+                    self.get_message,
+                ),
+                web.patch(
+                    API + "/webhooks/{webhook}/{token}/messages/{message}",
+                    self.edit_message,
+                ),
+                web.get("/origin/{name}", self.shortlink),
+                web.get("/origin/img/{name}", self.image),
+                web.get("/_stats", self.stats),
+                web.post("/_reset", self.reset_stats),
+            ]
+        )
+        return app
+
+    def _snowflake(self) -> int:
+        return next(self._ids)
+
+    @web.middleware
+    async def _limits(self, request: web.Request, handler):
+        if not request.path.startswith(API):
+            return await handler(request)
+        route = request.match_info.route.resource.canonical[len(API) :]
+        self.requests["{} {}".format(request.method, route)] += 1
+        await asyncio.sleep(
+            self.settings.latency + random.uniform(0, self.settings.jitter)
+        )
+
+        # Webhooks aren't subject to the bot's global limit
+        webhook = "webhook" in request.match_info
+        if not webhook:
+            retry_after = self._global.take()
+            if retry_after is not None:
+                return self._rate_limited(retry_after, is_global=True)
+        major = request.match_info.get("channel") or request.match_info.get("webhook")
+        bucket_key = (request.method + " " + route, major or "")
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = _Bucket(
+                self.settings.route_limit, self.settings.route_window
+            )
+        retry_after = bucket.take()
+        if retry_after is None and random.random() < self.settings.random_429_rate:
+            retry_after = random.uniform(0.1, 1.0)
+        if retry_after is not None:
+            return self._rate_limited(retry_after, bucket=bucket_key[0])
+
+        response = await handler(request)
+        response.headers.update(
+            {
+                "X-RateLimit-Limit": str(bucket.limit),
+                "X-RateLimit-Remaining": str(bucket.remaining),
+                "X-RateLimit-Reset": "{:.3f}".format(
+                    time.time() + bucket.reset_at - time.monotonic()
+                ),
+                "X-RateLimit-Reset-After": "{:.3f}".format(
+                    max(0.0, bucket.reset_at - time.monotonic())
+                ),
+                "X-RateLimit-Bucket": str(abs(hash(bucket_key[0]))),
+            }
+        )
+        return response
+
+    def _rate_limited(
+        self, retry_after: float, is_global: bool = False, bucket: str = "global"
+    ) -> web.Response:
+        self.rate_limited += 1
+        headers = {
+            "Retry-After": "{:.3f}".format(retry_after),
+            "X-RateLimit-Limit": str(self.settings.route_limit),
+            "X-RateLimit-Remaining": "0",
+            "X-RateLimit-Reset-After": "{:.3f}".format(retry_after),
+            "X-RateLimit-Reset": "{:.3f}".format(time.time() + retry_after),
+            "X-RateLimit-Bucket": str(abs(hash(bucket))),
+        }
+        if is_global:
+            headers["X-RateLimit-Global"] = "true"
+            headers["X-RateLimit-Scope"] = "global"
+        return web.json_response(
+            {
+                "message": "You are being rate limited.",
+                "retry_after": retry_after,
+                "global": is_global,
+            },
+            status=429,
+            headers=headers,
+        )
+
+    def _posted(self) -> None:
+        now = time.time()
+        if self.first_post is None:
+            self.first_post = now
+        self.last_post = now
+
+    def _user(self) -> dict:
+        return {
+            "id": "1",
+            "username": "Polarity",
+            "discriminator": "0001",
+            "avatar": None,
+            "bot": True,
+            "system": False,
+            "mfa_enabled": False,
+            "locale": "en-US",
+            "verified": True,
+            "flags": 0,
+            "public_flags": 0,
+            "premium_type": 0,
+        }
+
+    def _message(self, message_id: int, channel_id: int, embeds: List[dict]) -> dict:
+        return {
+            "id": str(message_id),
+            "channel_id": str(channel_id),
+            "author": self._user(),
+            "content": "",
+            "timestamp": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": embeds,
+            "pinned": False,
+            "type": 0,
+            "flags": 0,
+        }
+
+    async def get_me(self, request: web.Request) -> web.Response:
+        return web.json_response(self._user())
+
+    async def get_channel(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "id": request.match_info["channel"],
+                "type": 0,
+                "guild_id": "2",
+                "name": "announcements",
+                "position": 0,
+                "permission_overwrites": [],
+                "nsfw": False,
+                "parent_id": None,
+                "topic": None,
+                "last_message_id": None,
+                "rate_limit_per_user": 0,
+            }
+        )
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        channel_id = int(request.match_info["channel"])
+        message_id = self._snowflake()
+        self.messages[message_id] = (channel_id, body.get("embeds", []))
+        self._posted()
+        return web.json_response(
+            self._message(message_id, channel_id, body.get("embeds", []))
+        )
+
+    async def execute_webhook(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        # Webhook ids are made equal to their channel's id by the benchmarks
+        channel_id = int(request.match_info["webhook"])
+        message_id = self._snowflake()
+        self.messages[message_id] = (channel_id, body.get("embeds", []))
+        self._posted()
+        return web.json_response(
+            self._message(message_id, channel_id, body.get("embeds", []))
+        )
+
+    async def get_message(self, request: web.Request) -> web.Response:
+        message_id = int(request.match_info["message"])
+        if message_id not in self.messages:
+            return web.json_response(
+                {"message": "Unknown Message", "code": 10008}, status=404
+            )
+        channel_id, embeds = self.messages[message_id]
+        return web.json_response(self._message(message_id, channel_id, embeds))
+
+    async def edit_message(self, request: web.Request) -> web.Response:
+        message_id = int(request.match_info["message"])
+        if message_id not in self.messages:
+            return web.json_response(
+                {"message": "Unknown Message", "code": 10008}, status=404
+            )
+        body = await request.json()
+        channel_id, embeds = self.messages[message_id]
+        embeds = body.get("embeds", embeds)
+        self.messages[message_id] = (channel_id, embeds)
+        self._posted()
+        return web.json_response(self._message(message_id, channel_id, embeds))
+
+    async def shortlink(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        raise web.HTTPFound(
+            str(request.url.with_path("/origin/img/{}.png".format(name)))
+        )
+
+    async def image(self, request: web.Request) -> web.Response:
+        return web.Response(body=PNG, content_type="image/png")
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": dict(self.requests),
+                "total_requests": sum(self.requests.values()),
+                "rate_limited": self.rate_limited,
+                "first_post": self.first_post,
+                "last_post": self.last_post,
+            }
+        )
+
+    async def reset_stats(self, request: web.Request) -> web.Response:
+        self.reset()
+        return web.Response()
+
+
+def serve(port: int, settings: FakeDiscordSettings = FakeDiscordSettings()) -> None:
+    """Serve a FakeDiscord on localhost:port until the process is stopped"""
+    web.run_app(FakeDiscord(settings).app(), host="127.0.0.1", port=port, print=None)
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
@@ -0,0 +1,46 @@
+"""Added deliveryrun table
+
+Revision ID: 3c9e71a5d0b8
+Revises: 6a0b4cdac964
+Create Date: 2026-10-20 14:31:05.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "3c9e71a5d0b8"
+down_revision = "6a0b4cdac964"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "deliveryrun",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("started_at", sa.DateTime(), nullable=False),
+        sa.Column("feeds", sa.Integer(), nullable=False),
+        sa.Column("channels", sa.Integer(), nullable=False),
+        sa.Column("succeeded", sa.Integer(), nullable=False),
+        sa.Column("permanent_failures", sa.Integer(), nullable=False),
+        sa.Column("transient_failures", sa.Integer(), nullable=False),
+        sa.Column("rate_limited", sa.Integer(), nullable=False),
+        sa.Column("send_p50", sa.Float(), nullable=True),
+        sa.Column("send_p95", sa.Float(), nullable=True),
+        sa.Column("send_p99", sa.Float(), nullable=True),
+        sa.Column("wall_time", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_deliveryrun_started_at"),
+        "deliveryrun",
+        ["started_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_deliveryrun_started_at"), table_name="deliveryrun")
+    op.drop_table("deliveryrun")
@@ -0,0 +1,48 @@
+"""Added run totals to deliverybatch
+
+Revision ID: 8d41f0b7c2e3
+Revises: 3c9e71a5d0b8
+Create Date: 2026-10-21 10:12:47.203581
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "8d41f0b7c2e3"
+down_revision = "3c9e71a5d0b8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    for column in [
+        "channels",
+        "succeeded",
+        "permanent_failures",
+        "transient_failures",
+        "rate_limited",
+    ]:
+        op.add_column(
+            "deliverybatch",
+            sa.Column(column, sa.Integer(), server_default="0", nullable=False),
+        )
+    op.add_column(
+        "deliverybatch",
+        sa.Column(
+            "send_latencies", sa.JSON(), server_default=sa.text("'[]'"), nullable=False
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("deliverybatch", "send_latencies")
+    for column in [
+        "rate_limited",
+        "transient_failures",
+        "permanent_failures",
+        "succeeded",
+        "channels",
+    ]:
+        op.drop_column("deliverybatch", column)
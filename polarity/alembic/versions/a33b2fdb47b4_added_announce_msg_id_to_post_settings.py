@@ -0,0 +1,32 @@
+"""Added announce_msg_id to post settings tables
+
+Revision ID: a33b2fdb47b4
+Revises: f99041cbe6c4
+Create Date: 2026-10-19 15:12:08.904471
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "a33b2fdb47b4"
+down_revision = "f99041cbe6c4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "lostsectorpostsettings",
+        sa.Column("announce_msg_id", sa.BigInteger(), nullable=True),
+    )
+    op.add_column(
+        "xurpostsettings",
+        sa.Column("announce_msg_id", sa.BigInteger(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("xurpostsettings", "announce_msg_id")
+    op.drop_column("lostsectorpostsettings", "announce_msg_id")
@@ -0,0 +1,32 @@
+"""Added delivery failure cols to AutopostSubscription
+
+Revision ID: d243cedf2422
+Revises: a33b2fdb47b4
+Create Date: 2026-10-19 17:25:41.330918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "d243cedf2422"
+down_revision = "a33b2fdb47b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "autopostsubscription",
+        sa.Column("failure_count", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column(
+        "autopostsubscription",
+        sa.Column("quarantined_until", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("autopostsubscription", "quarantined_until")
+    op.drop_column("autopostsubscription", "failure_count")
@@ -0,0 +1,85 @@
+"""Merged autopost channel tables into AutopostSubscription
+
+Revision ID: f6088f615526
+Revises: 6198b20f6e44
+Create Date: 2026-10-19 11:02:14.183520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "f6088f615526"
+down_revision = "6198b20f6e44"
+branch_labels = None
+depends_on = None
+
+# Feed bits as in polarity.schemas.Feed
+LOST_SECTOR = 1
+XUR = 2
+
+
+def upgrade() -> None:
+    op.create_table(
+        "autopostsubscription",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("server_id", sa.BigInteger(), nullable=True),
+        sa.Column("feeds", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("lost_sector_msg_id", sa.BigInteger(), nullable=True),
+        sa.Column("xur_msg_id", sa.BigInteger(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_autopostsubscription_feeds",
+        "autopostsubscription",
+        ["feeds"],
+        postgresql_where=sa.text("feeds != 0"),
+    )
+    op.execute(
+        """
+        INSERT INTO autopostsubscription
+            (id, server_id, feeds, lost_sector_msg_id, xur_msg_id)
+        SELECT
+            COALESCE(ls.id, xur.id),
+            COALESCE(ls.server_id, xur.server_id),
+            (CASE WHEN ls.enabled THEN {ls} ELSE 0 END)
+                | (CASE WHEN xur.enabled THEN {xur} ELSE 0 END),
+            ls.last_msg_id,
+            xur.last_msg_id
+        FROM lostsectorautopostchannel ls
+        FULL OUTER JOIN xurautopostchannel xur ON ls.id = xur.id
+        """.format(
+            ls=LOST_SECTOR, xur=XUR
+        )
+    )
+    op.drop_table("lostsectorautopostchannel")
+    op.drop_table("xurautopostchannel")
+
+
+def downgrade() -> None:
+    for table, feed, msg_id_column in [
+        ("lostsectorautopostchannel", LOST_SECTOR, "lost_sector_msg_id"),
+        ("xurautopostchannel", XUR, "xur_msg_id"),
+    ]:
+        op.create_table(
+            table,
+            sa.Column("id", sa.BigInteger(), nullable=False),
+            sa.Column("server_id", sa.BigInteger(), nullable=True),
+            sa.Column("last_msg_id", sa.BigInteger(), nullable=True),
+            sa.Column("enabled", sa.Boolean(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        # Channels that were never subscribed to a feed had no row for it
+        op.execute(
+            """
+            INSERT INTO {table} (id, server_id, last_msg_id, enabled)
+            SELECT id, server_id, {msg_id_column}, (feeds & {feed}) != 0
+            FROM autopostsubscription
+            WHERE (feeds & {feed}) != 0 OR {msg_id_column} IS NOT NULL
+            """.format(
+                table=table, feed=feed, msg_id_column=msg_id_column
+            )
+        )
+    op.drop_index("ix_autopostsubscription_feeds", "autopostsubscription")
+    op.drop_table("autopostsubscription")
@@ -0,0 +1,32 @@
+"""Added webhook cols to AutopostSubscription
+
+Revision ID: f99041cbe6c4
+Revises: f6088f615526
+Create Date: 2026-10-19 13:40:52.617034
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "f99041cbe6c4"
+down_revision = "f6088f615526"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "autopostsubscription",
+        sa.Column("webhook_id", sa.BigInteger(), nullable=True),
+    )
+    op.add_column(
+        "autopostsubscription",
+        sa.Column("webhook_token", sa.String(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("autopostsubscription", "webhook_token")
+    op.drop_column("autopostsubscription", "webhook_id")
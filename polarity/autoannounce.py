@@ -1,23 +1,30 @@
-import asyncio
 import datetime as dt
 import logging
-from typing import Union
+import time
+from typing import List, Optional, Tuple, Union
 
 import hikari
 import lightbulb
-import re
 from aiohttp import web
-from sqlalchemy import select, update
 
-from . import cfg, custom_checks
+from . import cfg, custom_checks, logs, metrics, profiling, rest_lanes, tracing
+from .delivery import (
+    FeedDelivery,
+    coalescer,
+    create_delivery_webhook,
+    delete_delivery_webhook,
+)
+from .preflight import preflight
+from .rehost import rehost_image
+from .rest_lanes import Lane
 from .schemas import (
-    LostSectorAutopostChannel,
+    AutopostSubscription,
+    Feed,
     LostSectorPostSettings,
-    XurAutopostChannel,
     XurPostSettings,
 )
 from .user_commands import get_lost_sector_text, get_xur_text
-from .utils import _create_or_get, db_session, operation_timer
+from .utils import _create_or_get, db_session, pool_stats
 
 app = web.Application()
 
@@ -26,6 +33,8 @@ class BaseCustomEvent(hikari.Event):
     def __init__(self, bot) -> None:
         super().__init__()
         self.bot: lightbulb.BotApp = bot
+        # Monotonic time of the reset that led to this event, if any
+        self.reset_at: Optional[float] = None
 
     @property
     def app(self) -> lightbulb.BotApp:
@@ -38,8 +47,12 @@ class BaseCustomEvent(hikari.Event):
 # as a hikari.Event that is dispatched bot-wide
 class ResetSignal(BaseCustomEvent):
     qualifier: str
+    # Monotonic time the signal was fired, None when dispatched directly
+    received_at: Optional[float] = None
 
     def fire(self) -> None:
+        # Announcements triggered by this reset measure their latency from here
+        self.received_at = time.monotonic()
         self.bot.event_manager.dispatch(self)
 
     async def remote_fire(self, request: web.Request) -> web.Response:
@@ -85,6 +98,7 @@ class WeekendResetSignal(ResetSignal):
 class LostSectorSignal(BaseCustomEvent):
     async def conditional_daily_reset_repeater(self, event: DailyResetSignal) -> None:
         if await self.is_autoannounce_enabled():
+            self.reset_at = event.received_at
             event.bot.dispatch(self)
 
     async def is_autoannounce_enabled(self):
@@ -105,6 +119,7 @@ class XurSignal(BaseCustomEvent):
             return
 
         settings: XurPostSettings = await _create_or_get(XurPostSettings, 0)
+        self.reset_at = event.received_at
 
         # Debug code
         if cfg.test_env and cfg.trigger_without_url_update:
@@ -125,108 +140,95 @@ class XurSignal(BaseCustomEvent):
         await settings.wait_for_url_update()
 
 
-async def _send_embed_if_textable_channel(
-    channel_id: int,
-    event: hikari.Event,
-    embed: hikari.Embed,
-    channel_table,  # Must be the class of the channel, not an instance
-) -> None:
-    try:
-        channel = await event.bot.rest.fetch_channel(channel_id)
-        # Can add hikari.GuildNewsChannel for announcement channel support
-        # could be useful if we automate more stuff for Kyber
-        if isinstance(channel, hikari.TextableChannel):
-            async with db_session() as session:
-                async with session.begin():
-                    channel_record = await session.get(channel_table, channel_id)
-                    channel_record.last_msg_id = await channel.send(embed=embed)
-    except (hikari.ForbiddenError, hikari.NotFoundError):
-        logging.warning(
-            "Channel {} not found or not messageable, disabling posts in {}".format(
-                channel_id, str(channel_table.__class__.__name__)
-            )
-        )
-        async with db_session() as session:
-            async with session.begin():
-                await session.execute(
-                    update(channel_table)
-                    .where(channel_table.id == channel_id)
-                    .values(enabled=False)
-                )
-
-
 async def _edit_embedded_message(
     message_id: int,
     channel_id: int,
     bot: hikari.GatewayBot,
     embed: hikari.Embed,
+    webhook_id: int = None,
+    webhook_token: str = None,
 ) -> None:
+    # Corrections touch every channel, so they go in the bulk lane
     try:
+        if webhook_id is not None:
+            # Posts made through a webhook can only be edited through it
+            try:
+                msg = await bot.rest.fetch_webhook_message(
+                    webhook_id, webhook_token, message_id
+                )
+                await bot.rest.edit_webhook_message(
+                    webhook_id,
+                    webhook_token,
+                    message_id,
+                    embeds=_replace_embed(msg.embeds, embed),
+                )
+                return
+            except (hikari.NotFoundError, hikari.UnauthorizedError):
+                # Webhook is gone or the post was made by the bot
+                pass
+        await rest_lanes.acquire(Lane.BULK)
         msg: hikari.Message = await bot.rest.fetch_message(channel_id, message_id)
         if isinstance(msg, hikari.Message):
-            await msg.edit(content="", embed=embed)
+            await rest_lanes.acquire(Lane.BULK)
+            await msg.edit(content="", embeds=_replace_embed(msg.embeds, embed))
     except (hikari.ForbiddenError, hikari.NotFoundError):
-        logging.warning("Message {} not found or not editable".format(message_id))
+        logging.warning(
+            "Message {} not found or not editable".format(message_id),
+            extra=logs.aggregate(
+                "posts not found or not editable", channel_id=channel_id
+            ),
+        )
+
+
+def _replace_embed(embeds: List[hikari.Embed], embed: hikari.Embed):
+    # Messages can carry the embeds of several feeds, only
+    # replace the one for the feed being corrected
+    new_embeds = [e if e.title != embed.title else embed for e in embeds]
+    if embed not in new_embeds:
+        new_embeds = [embed]
+    return new_embeds
 
 
 async def lost_sector_announcer(event: LostSectorSignal):
-    async with db_session() as session:
-        async with session.begin():
-            channel_id_list = (
-                await session.execute(
-                    select(LostSectorAutopostChannel).where(
-                        LostSectorAutopostChannel.enabled == True
-                    )
-                )
-            ).fetchall()
-            channel_id_list = [] if channel_id_list is None else channel_id_list
-            channel_id_list = [channel[0].id for channel in channel_id_list]
-
-    logging.info("Announcing lost sectors to {} channels".format(len(channel_id_list)))
-    with operation_timer("Lost sector announce"):
-        embed = await get_lost_sector_text()
-
-        await asyncio.gather(
-            *[
-                _send_embed_if_textable_channel(
-                    channel_id,
-                    event,
-                    embed,
-                    LostSectorAutopostChannel,
+    logging.info("Announcing lost sectors")
+    with coalescer.expecting(Feed.LOST_SECTOR):
+        async with profiling.announcement("Lost sector announce"):
+            with tracing.span("Lost sector announce"):
+                with tracing.span("render"):
+                    embed = await get_lost_sector_text()
+                with tracing.span("preflight"):
+                    if not await preflight(event.bot, Feed.LOST_SECTOR, embed):
+                        return
+                with tracing.span("rehost"):
+                    embed = await rehost_image(event.bot, Feed.LOST_SECTOR, embed)
+
+                await coalescer.deliver(
+                    event.bot, FeedDelivery(Feed.LOST_SECTOR, embed, event.reset_at)
                 )
-                for channel_id in channel_id_list
-            ]
-        )
+    logging.info(str(pool_stats))
 
 
 async def xur_announcer(event: XurSignal):
     async with db_session() as session:
         async with session.begin():
             settings: XurPostSettings = await session.get(XurPostSettings, 0)
-        async with session.begin():
-            channel_id_list = (
-                await session.execute(
-                    select(XurAutopostChannel).where(XurAutopostChannel.enabled == True)
+
+    logging.info("Announcing xur posts")
+    with coalescer.expecting(Feed.XUR):
+        async with profiling.announcement("Xur announce"):
+            with tracing.span("Xur announce"):
+                with tracing.span("render"):
+                    embed = await get_xur_text(settings.url, settings.post_url)
+                with tracing.span("preflight"):
+                    if not await preflight(event.bot, Feed.XUR, embed):
+                        return
+                with tracing.span("rehost"):
+                    embed = await rehost_image(event.bot, Feed.XUR, embed)
+
+                await coalescer.deliver(
+                    event.bot, FeedDelivery(Feed.XUR, embed, event.reset_at)
                 )
-            ).fetchall()
-            channel_id_list = [] if channel_id_list is None else channel_id_list
-            channel_id_list = [channel[0].id for channel in channel_id_list]
-
-        logging.info("Announcing xur posts to {} channels".format(len(channel_id_list)))
-        with operation_timer("Xur announce"):
-            embed = await get_xur_text(settings.url, settings.post_url)
-
-            await asyncio.gather(
-                *[
-                    _send_embed_if_textable_channel(
-                        channel_id,
-                        event,
-                        embed,
-                        XurAutopostChannel,
-                    )
-                    for channel_id in channel_id_list
-                ]
-            )
+    logging.info(str(pool_stats))
 
 
 @lightbulb.add_checks(
@@ -243,27 +245,24 @@ async def autopost_cmd_group(ctx: lightbulb.Context) -> None:
     )
 
 
-def make_autoannounce_control_user_command(channel_table):
-    # Uses a LostSectorAutopostChannel or XurAutopostChannel like table
-    # to make a command for the user to be able to control autoposts in their
-    # server
-    cls_name = channel_table.__name__
-    name_list = re.findall("[A-Z][^A-Z]*", cls_name)
-    name = " ".join(name_list[:-2])
-    cmd_name = "".join(name_list[:-2])
+def make_autoannounce_control_user_command(feed: Feed):
+    # Makes a command for the user to be able to control autoposts
+    # of a feed in their server
+    name = feed.label
+    cmd_name = name.replace(" ", "")
 
     # Function creation
     @autopost_cmd_group.child
     @lightbulb.option(
         "option",
-        "Enabled or disabled",
+        "Enabled or disabled, or follow Kyber's announcement channel instead",
         type=str,
-        choices=["Enable", "Disable"],
+        choices=["Enable", "Disable", "Follow"],
         required=True,
     )
     @lightbulb.command(
         cmd_name.lower(),
-        "Lost sector auto posts",
+        name + " auto posts",
         auto_defer=True,
         guilds=cfg.kyber_discord_server_id,
         inherit_checks=True,
@@ -272,21 +271,38 @@ def make_autoannounce_control_user_command(channel_table):
     async def generic_autopost_user_side_controller(ctx: lightbulb.Context) -> None:
         channel_id: int = ctx.channel_id
         server_id: int = ctx.guild_id if ctx.guild_id is not None else -1
+        follow: bool = ctx.options.option.lower() == "follow"
         option: bool = True if ctx.options.option.lower() == "enable" else False
         bot = ctx.bot
+        if follow:
+            followed, response = await _follow_announce_channel(bot, feed, channel_id)
+            await ctx.respond(response)
+            if not followed:
+                return
+            # Discord delivers the posts from now on, so the bot
+            # stops sending them here itself
+            option = False
         if await _bot_has_message_perms(bot, channel_id):
             async with db_session() as session:
                 async with session.begin():
-                    channel = await session.get(channel_table, channel_id)
+                    channel = await session.get(AutopostSubscription, channel_id)
                     if channel is None:
-                        channel = channel_table(channel_id, server_id, option)
+                        channel = AutopostSubscription(channel_id, server_id)
                         session.add(channel)
+                    if option:
+                        channel.feeds = int(channel.feeds | feed)
                     else:
-                        channel.enabled = option
-            await ctx.respond(
-                name + " autoposts {}".format("enabled" if option else "disabled")
-            )
-        else:
+                        channel.feeds = int(channel.feeds & ~feed)
+            # Only once the feeds are committed, see create_delivery_webhook
+            if cfg.webhook_delivery and channel.feeds:
+                await create_delivery_webhook(bot, channel_id)
+            elif not channel.feeds:
+                await delete_delivery_webhook(bot, channel_id)
+            if not follow:
+                await ctx.respond(
+                    name + " autoposts {}".format("enabled" if option else "disabled")
+                )
+        elif not follow:
             await ctx.respond(
                 'The bot does not have the "Send Messages" or the'
                 + ' "Send Messages in Threads" permission here'
@@ -296,10 +312,10 @@ def make_autoannounce_control_user_command(channel_table):
     return generic_autopost_user_side_controller
 
 
-lost_sector_auto = make_autoannounce_control_user_command(LostSectorAutopostChannel)
+lost_sector_auto = make_autoannounce_control_user_command(Feed.LOST_SECTOR)
 
 
-xur_auto = make_autoannounce_control_user_command(XurAutopostChannel)
+xur_auto = make_autoannounce_control_user_command(Feed.XUR)
 
 
 @autopost_cmd_group.set_error_handler
@@ -313,6 +329,30 @@ async def announcements_error_handler(
     )
 
 
+async def _follow_announce_channel(
+    bot: lightbulb.BotApp, feed: Feed, channel_id: int
+) -> Tuple[bool, str]:
+    # Returns whether the channel now follows and the response for the user
+    if feed.announce_channel_id is None:
+        return False, "Following is not available for {} posts".format(feed.label)
+    try:
+        await rest_lanes.acquire(Lane.ADMIN)
+        await bot.rest.follow_channel(
+            feed.announce_channel_id,
+            channel_id,
+            reason="{} autoposts".format(feed.label),
+        )
+    except (hikari.ForbiddenError, hikari.BadRequestError):
+        return False, (
+            "Could not follow the {} announcement channel here, the bot needs"
+            + ' the "Manage Webhooks" permission and this needs to be a text channel'
+        ).format(feed.label)
+    return True, (
+        "This channel now follows the {} announcement channel, this can be"
+        + " undone by deleting the follow in this server's integration settings"
+    ).format(feed.label)
+
+
 def _wire_listeners(bot: lightbulb.BotApp) -> None:
     """Connects all listener coroutines to the bot"""
     for handler in [lost_sector_announcer, xur_announcer]:
@@ -322,11 +362,15 @@ def _wire_listeners(bot: lightbulb.BotApp) -> None:
 async def _bot_has_message_perms(
     bot: lightbulb.BotApp, channel: Union[hikari.TextableChannel, int]
 ) -> bool:
+    # Only used by the autopost commands, so these go in the admin lane
     if not isinstance(channel, hikari.TextableChannel):
+        await rest_lanes.acquire(Lane.ADMIN)
         channel = await bot.rest.fetch_channel(channel)
     if isinstance(channel, hikari.TextableChannel):
         if isinstance(channel, hikari.TextableGuildChannel):
+            await rest_lanes.acquire(Lane.ADMIN)
             guild = await channel.fetch_guild()
+            await rest_lanes.acquire(Lane.ADMIN)
             self_member = await bot.rest.fetch_member(guild, bot.get_me())
             perms = lightbulb.utils.permissions_in(channel, self_member)
             # Check if we have the send messages permission in the channel
@@ -358,6 +402,7 @@ async def arm(bot: lightbulb.BotApp) -> None:
     _wire_listeners(bot)
     # Connect commands
     bot.command(autopost_cmd_group)
+    metrics.arm(bot, app)
     # Start the web server for periodic signals from apscheduler
     runner = web.AppRunner(app)
     await runner.setup()
@@ -1,4 +1,6 @@
 import abc
+import functools
+import operator
 from os import getenv as _getenv
 
 import hikari
@@ -21,6 +23,27 @@ if db_url.startswith("postgres"):
 # Async SQLAlchemy DB Session KWArg Parameters
 db_session_kwargs = {"expire_on_commit": False, "class_": AsyncSession}
 
+# Async SQLAlchemy engine / connection pool parameters
+# Announcements open a session per channel, so the pool needs to be
+# sized for bursts at reset time rather than for steady state traffic
+# The defaults match SQLAlchemy's own defaults
+db_pool_size = int(_getenv("DB_POOL_SIZE") or 5)
+db_max_overflow = int(_getenv("DB_MAX_OVERFLOW") or 10)
+# Seconds to wait for a connection before giving up
+db_pool_timeout = float(_getenv("DB_POOL_TIMEOUT") or 30)
+# Seconds after which connections are recycled, -1 to disable
+db_pool_recycle = int(_getenv("DB_POOL_RECYCLE") or -1)
+# Number of prepared statements asyncpg caches per connection, 0 to disable
+db_statement_cache_size = int(_getenv("DB_STATEMENT_CACHE_SIZE") or 100)
+
+db_engine_kwargs = {
+    "pool_size": db_pool_size,
+    "max_overflow": db_max_overflow,
+    "pool_timeout": db_pool_timeout,
+    "pool_recycle": db_pool_recycle,
+    "connect_args": {"prepared_statement_cache_size": db_statement_cache_size},
+}
+
 # Debug envs
 test_env = _getenv("TEST_ENV") or "false"
 test_env = int(test_env) if test_env != "false" else False
@@ -33,30 +56,183 @@ admin_role = int(_getenv("ADMIN_ROLE"))
 
 kyber_discord_server_id = int(_getenv("KYBER_DISCORD_SERVER_ID"))
 
+# Announcement channels in the Kyber server that feeds are posted and
+# published to, so discord delivers them to every channel following them
+# Keyed by lowercase feed name, None if a feed has no announcement channel
+announce_channel_ids = {
+    feed: int(_getenv(feed.upper() + "_ANNOUNCE_CHANNEL_ID") or 0) or None
+    for feed in ["lost_sector", "xur"]
+}
+
+
+def _flags(flag_type, names: str):
+    # "A | B" -> flag_type.A | flag_type.B
+    return functools.reduce(
+        operator.or_,
+        [flag_type[name.strip().upper()] for name in names.split("|") if name.strip()],
+        flag_type.NONE,
+    )
+
+
+# Gateway intents and cache components, as | separated names of
+# hikari.Intents and hikari.api.CacheComponents members
+# Commands come in as interactions, which need no intents, so only guilds
+# are needed (for the server count and permission checks). The bot's own
+# member is fetched over REST, so members, presences and messages are
+# neither received nor cached
+gateway_intents = _flags(hikari.Intents, _getenv("GATEWAY_INTENTS") or "GUILDS")
+cache_components = _flags(
+    hikari.api.CacheComponents,
+    _getenv("CACHE_COMPONENTS") or "GUILDS | GUILD_CHANNELS | ROLES | ME",
+)
+
 lightbulb_params = (
     # Only use the test env for testing if it is specified
     {"token": main_token, "default_enabled_guilds": test_env}
     if test_env
     else {"token": main_token}  # Test env isn't specified in production
 )
+lightbulb_params.update(
+    {
+        "intents": gateway_intents,
+        "cache_settings": hikari.impl.CacheSettings(components=cache_components),
+        # Logging is set up by logs.setup rather than by hikari
+        "logs": None,
+    }
+)
+
+# Serve custom commands through a single /info <name> command rather than
+# registering one slash command each, avoids discord's command limits
+custom_commands_dispatcher = _getenv("CUSTOM_COMMANDS_DISPATCHER") or "false"
+custom_commands_dispatcher = (
+    True if custom_commands_dispatcher.lower() == "true" else False
+)
+custom_commands_dispatcher_name = _getenv("CUSTOM_COMMANDS_DISPATCHER_NAME") or "info"
+
+# Seconds to wait after the last custom command change before
+# syncing the changed commands with discord
+command_sync_delay = float(_getenv("COMMAND_SYNC_DELAY") or 5)
+# Seconds link redirects in custom command responses are cached for
+redirect_cache_ttl = float(_getenv("REDIRECT_CACHE_TTL") or 300)
+
+# Where finished traces of announcement runs are exported to, see tracing.py
+# A file to append spans to as JSON lines
+trace_file = _getenv("TRACE_FILE") or None
+# An OTLP/HTTP traces endpoint, eg. http://localhost:4318/v1/traces
+otlp_endpoint = _getenv("OTLP_ENDPOINT") or None
+
+# Watch the event loop for blocking calls, see loop_monitor.py
+loop_monitor_enabled = _getenv("LOOP_MONITOR") or "false"
+loop_monitor_enabled = True if loop_monitor_enabled.lower() == "true" else False
+# Seconds between lag measurements
+loop_monitor_interval = float(_getenv("LOOP_MONITOR_INTERVAL") or 0.25)
+# Seconds the loop may be blocked for before the blocking stack is logged
+loop_lag_threshold = float(_getenv("LOOP_LAG_THRESHOLD") or 0.5)
+
+# Directory profiles from /kyber debug profile are saved to
+profile_dir = _getenv("PROFILE_DIR") or "profiles"
+# Number of functions listed in profile summaries
+profile_top = int(_getenv("PROFILE_TOP") or 15)
+
+log_level = _getenv("LOG_LEVEL") or "INFO"
+# Write logs as JSON lines rather than plain text
+log_json = _getenv("LOG_JSON") or "true"
+log_json = True if log_json.lower() == "true" else False
+# Seconds over which repeated per channel messages are summed up
+log_aggregate_window = float(_getenv("LOG_AGGREGATE_WINDOW") or 10)
+
+
+def gsheets_credentials() -> dict:
+    # Built when the sheet is first read rather than at import, processes
+    # that never read it don't need the Sheets variables set
+    return {
+        "type": "service_account",
+        "project_id": _getenv("SHEETS_PROJECT_ID"),
+        "private_key_id": _getenv("SHEETS_PRIVATE_KEY_ID"),
+        "private_key": _getenv("SHEETS_PRIVATE_KEY").replace("\\n", "\n"),
+        "client_email": _getenv("SHEETS_CLIENT_EMAIL"),
+        "client_id": _getenv("SHEETS_CLIENT_ID"),
+        "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+        "client_x509_cert_url": _getenv("SHEETS_CLIENT_X509_CERT_URL"),
+    }
 
-gsheets_credentials = {
-    "type": "service_account",
-    "project_id": _getenv("SHEETS_PROJECT_ID"),
-    "private_key_id": _getenv("SHEETS_PRIVATE_KEY_ID"),
-    "private_key": _getenv("SHEETS_PRIVATE_KEY").replace("\\n", "\n"),
-    "client_email": _getenv("SHEETS_CLIENT_EMAIL"),
-    "client_id": _getenv("SHEETS_CLIENT_ID"),
-    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-    "token_uri": "https://oauth2.googleapis.com/token",
-    "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-    "client_x509_cert_url": _getenv("SHEETS_CLIENT_X509_CERT_URL"),
-}
 
 sheets_ls_url = _getenv("SHEETS_LS_URL")
+# Seconds the lost sector rotation read from Sheets is reused for. It is
+# read ahead of time at startup, edits to the sheet show up after this long
+rotation_cache_ttl = float(_getenv("ROTATION_CACHE_TTL") or 600)
 
 port = int(_getenv("PORT") or 5000)
 
+# Longest a feed waits, in seconds, for other feeds that are being
+# prepared at the same time so they go out as a single message per channel
+delivery_coalesce_window = float(_getenv("DELIVERY_COALESCE_WINDOW") or 5)
+
+# Deliver autoposts through a webhook made in each channel when it is
+# enabled, rather than through the bot. Webhooks have their own rate
+# limit buckets instead of sharing the bot's global one
+webhook_delivery = _getenv("WEBHOOK_DELIVERY") or "false"
+webhook_delivery = True if webhook_delivery.lower() == "true" else False
+
+# Deliveries that fail for reasons that may go away (5xx, timeouts,
+# connection resets, long rate limits) are retried after the main pass
+delivery_max_attempts = int(_getenv("DELIVERY_MAX_ATTEMPTS") or 4)
+delivery_retry_concurrency = int(_getenv("DELIVERY_RETRY_CONCURRENCY") or 5)
+# Seconds, doubled on every attempt up to the max
+delivery_retry_base_delay = float(_getenv("DELIVERY_RETRY_BASE_DELAY") or 2)
+delivery_retry_max_delay = float(_getenv("DELIVERY_RETRY_MAX_DELAY") or 60)
+# Channels are skipped for delivery_quarantine_hours after this many
+# consecutive runs in which delivery failed even after retries
+delivery_quarantine_after = int(_getenv("DELIVERY_QUARANTINE_AFTER") or 3)
+delivery_quarantine_hours = float(_getenv("DELIVERY_QUARANTINE_HOURS") or 24)
+
+# Hand deliveries to separate delivery worker processes through a db
+# queue instead of sending them from the bot process
+# See polarity/delivery_worker.py
+delivery_worker = _getenv("DELIVERY_WORKER") or "false"
+delivery_worker = True if delivery_worker.lower() == "true" else False
+# Jobs a worker takes from the queue at a time
+delivery_worker_batch_size = int(_getenv("DELIVERY_WORKER_BATCH_SIZE") or 100)
+# Seconds a worker waits before checking an empty queue again
+delivery_worker_poll_interval = float(_getenv("DELIVERY_WORKER_POLL_INTERVAL") or 1)
+# Seconds a worker has to deliver the jobs it took before other workers may
+# take them up again, longer than a lot of jobs takes to deliver
+delivery_worker_lease = float(_getenv("DELIVERY_WORKER_LEASE") or 600)
+# Number of delivery worker processes running, they share the bot's
+# global request budget between them
+delivery_worker_count = int(_getenv("DELIVERY_WORKER_COUNT") or 1)
+
+# Requests per second the bot paces its REST traffic to, kept a little
+# under discord's global limit of 50
+rest_global_rate = float(_getenv("REST_GLOBAL_RATE") or 45)
+# Share of that rate guaranteed to admin commands during bulk fan-out
+rest_admin_share = float(_getenv("REST_ADMIN_SHARE") or 0.2)
+
+# Check that announcement images resolve to an image before sending
+# announcements out, holding them for an admin if they don't
+preflight_enabled = _getenv("PREFLIGHT_CHECKS") or "true"
+preflight_enabled = True if preflight_enabled.lower() == "true" else False
+# Seconds to wait for the image host
+preflight_timeout = float(_getenv("PREFLIGHT_TIMEOUT") or 10)
+# Held announcements are discarded if not released within this time
+preflight_hold_minutes = float(_getenv("PREFLIGHT_HOLD_MINUTES") or 60)
+# Channel in the Kyber server that problems are reported to, if any
+alerts_channel_id = int(_getenv("ALERTS_CHANNEL_ID") or 0) or None
+# Channel in the Kyber server that infographics are uploaded to once per
+# period, so announcements embed them from Discord's CDN rather than
+# pointing every guild at the origin. Unset to embed the origin URL
+image_rehost_channel_id = int(_getenv("IMAGE_REHOST_CHANNEL_ID") or 0) or None
+# Seconds an upload is reused for, kept well under the 24 hours Discord's
+# signed attachment urls stay valid for
+image_rehost_ttl = float(_getenv("IMAGE_REHOST_TTL") or 12 * 60 * 60)
+# Seconds a correction waits before editing posts, a newer correction for
+# the same feed within this time replaces it before any edits are made
+correction_debounce = float(_getenv("CORRECTION_DEBOUNCE") or 3)
+# Seconds between progress updates to the admin running a correction
+correction_progress_interval = float(_getenv("CORRECTION_PROGRESS_INTERVAL") or 5)
+
 kyber_pink = hikari.Color(0xEC42A5)
 
 
@@ -0,0 +1,111 @@
+# Incremental application command syncing
+# lightbulb's sync_application_commands re-PUTs the bot's entire command
+# tree, which gets slower and heavier with every custom command added.
+# Custom commands change one at a time though, so we only upsert or
+# delete the commands that changed through the single command endpoints,
+# and batch bursts of admin edits into one sync after a quiet period.
+
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import hikari
+import lightbulb
+
+from . import cfg, rest_lanes
+from .rest_lanes import Lane
+
+
+class CommandSyncer:
+    def __init__(self, bot: lightbulb.BotApp, delay: float = cfg.command_sync_delay):
+        self.bot = bot
+        self.delay = delay
+        # Command name -> (whether it should exist on discord, command)
+        self._pending: Dict[str, Tuple[bool, lightbulb.commands.base.Command]] = {}
+        # (Command name, guild id or None if global) -> discord side command id
+        self._ids: Dict[Tuple[str, Optional[int]], hikari.Snowflake] = {}
+        self._deadline = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def upsert(self, command: lightbulb.commands.base.Command) -> None:
+        self._pending[command.name] = (True, command)
+        self._schedule()
+
+    def delete(self, command: lightbulb.commands.base.Command) -> None:
+        self._pending[command.name] = (False, command)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        # Every change pushes the sync back so that a burst of edits
+        # results in a single sync once the admin is done
+        self._deadline = time.monotonic() + self.delay
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            while (remaining := self._deadline - time.monotonic()) > 0:
+                await asyncio.sleep(remaining)
+            pending, self._pending = self._pending, {}
+            logging.info("Syncing {} changed commands".format(len(pending)))
+            for name, (present, command) in pending.items():
+                try:
+                    if present:
+                        await self._upsert(command)
+                    else:
+                        await self._delete(command)
+                except hikari.HTTPError:
+                    logging.exception("Failed to sync command {}".format(name))
+
+    def _guilds(self, command: lightbulb.commands.base.Command) -> Iterable:
+        # None stands for a global command
+        return command.guilds or self.bot.default_enabled_guilds or [None]
+
+    async def _application(self) -> hikari.Application:
+        if self.bot.application is None:
+            await rest_lanes.acquire(Lane.ADMIN)
+            self.bot.application = await self.bot.rest.fetch_application()
+        return self.bot.application
+
+    async def _upsert(self, command: lightbulb.commands.base.Command) -> None:
+        await self._application()
+        for guild in self._guilds(command):
+            # Creating a command with an existing name overwrites it
+            # so this covers both new and edited commands
+            await rest_lanes.acquire(Lane.ADMIN)
+            created = await command.create(guild)
+            self._ids[(command.name, guild)] = created.id
+            logging.info("{} command synced".format(command.name))
+
+    async def _delete(self, command: lightbulb.commands.base.Command) -> None:
+        application = await self._application()
+        for guild in self._guilds(command):
+            guild_ = hikari.UNDEFINED if guild is None else guild
+            command_id = self._ids.pop((command.name, guild), None)
+            if command_id is None:
+                # Not created by us since startup, look it up instead
+                await rest_lanes.acquire(Lane.ADMIN)
+                for remote in await self.bot.rest.fetch_application_commands(
+                    application, guild=guild_
+                ):
+                    if remote.name == command.name:
+                        command_id = remote.id
+                        break
+                else:
+                    continue
+            await rest_lanes.acquire(Lane.ADMIN)
+            await self.bot.rest.delete_application_command(
+                application, command_id, guild=guild_
+            )
+            logging.info("{} command removed".format(command.name))
+
+
+_syncer: Optional[CommandSyncer] = None
+
+
+def get_syncer(bot: lightbulb.BotApp) -> CommandSyncer:
+    global _syncer
+    if _syncer is None or _syncer.bot is not bot:
+        _syncer = CommandSyncer(bot)
+    return _syncer
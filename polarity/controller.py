@@ -1,4 +1,3 @@
-import asyncio
 import logging
 from typing import List
 
@@ -6,13 +5,21 @@ import lightbulb
 from sqlalchemy import select
 import datetime as dt
 
-from polarity.schemas import LostSectorPostSettings, XurAutopostChannel, XurPostSettings
+from polarity.schemas import (
+    AutopostSubscription,
+    DeliveryRun,
+    Feed,
+    LostSectorPostSettings,
+    XurPostSettings,
+)
 from polarity.user_commands import get_xur_text
-from polarity.utils import operation_timer
+from polarity.utils import pool_stats
 
-from . import cfg
+from . import cfg, corrections, preflight, profiling, tracing
+from .rehost import rehost_image
 from .schemas import XurPostSettings, db_session
-from .autoannounce import XurSignal, _edit_embedded_message
+from .autoannounce import XurSignal
+from .corrections import CorrectionTarget
 
 
 @lightbulb.add_checks(lightbulb.checks.has_roles(cfg.admin_role))
@@ -184,7 +191,25 @@ async def xur_post_url(ctx: lightbulb.Context):
     await ctx.respond("Xur Post url updated to <{}>".format(url))
 
 
+async def _xur_subscriptions(session) -> List[AutopostSubscription]:
+    """Full records of every channel subscribed to xur posts"""
+    channel_record_list = (
+        await session.execute(
+            select(AutopostSubscription).where(
+                AutopostSubscription.subscribed_to(Feed.XUR)
+            )
+        )
+    ).fetchall()
+    return [channel[0] for channel in channel_record_list]
+
+
 @xur_announcements.child
+@lightbulb.option(
+    "force",
+    "Correct posts even if the infographic fails pre-flight checks",
+    type=bool,
+    default=False,
+)
 @lightbulb.option(
     "change",
     "What has changed",
@@ -207,37 +232,43 @@ async def xur_rectify_announcement(ctx: lightbulb.Context):
             settings: XurPostSettings = await session.get(XurPostSettings, 0)
             if settings is None:
                 await ctx.respond("Please enable xur autoposts before using this cmd")
-            channel_record_list = (
-                await session.execute(
-                    select(XurAutopostChannel).where(XurAutopostChannel.enabled == True)
-                )
-            ).fetchall()
-            channel_record_list = (
-                [] if channel_record_list is None else channel_record_list
-            )
-            channel_record_list: List[XurAutopostChannel] = [
-                channel[0] for channel in channel_record_list
-            ]
+            channel_record_list = await _xur_subscriptions(session)
         logging.info("Correcting xur posts")
-        with operation_timer("Xur announce correction"):
+        with tracing.span("Xur announce correction", channels=len(channel_record_list)):
             await ctx.respond("Correcting posts now")
             embed = await get_xur_text(
                 settings.url,
                 settings.post_url,
                 change,
             )
-            await asyncio.gather(
-                *[
-                    _edit_embedded_message(
-                        channel_record.last_msg_id,
-                        channel_record.id,
-                        ctx.bot,
-                        embed,
+            problem = await preflight.check_image(embed.image.url)
+            if problem is not None and not ctx.options.force:
+                await ctx.edit_last_response(
+                    "Not correcting posts, the infographic <{}> {}\n".format(
+                        embed.image.url, problem
                     )
-                    for channel_record in channel_record_list
-                ]
-            )
-            await ctx.edit_last_response("Posts corrected")
+                    + "Use the force option to correct them anyway"
+                )
+                return
+            embed = await rehost_image(ctx.bot, Feed.XUR, embed)
+            targets = [
+                CorrectionTarget(
+                    channel_record.xur_msg_id,
+                    channel_record.id,
+                    channel_record.webhook_id,
+                    channel_record.webhook_token,
+                )
+                for channel_record in channel_record_list
+                if channel_record.xur_msg_id is not None
+            ]
+            if Feed.XUR.announce_channel_id and settings.announce_msg_id:
+                # Edits are passed on to channels following the announcement
+                targets.append(
+                    CorrectionTarget(
+                        settings.announce_msg_id, Feed.XUR.announce_channel_id
+                    )
+                )
+            await corrections.runner.correct(ctx, Feed.XUR, embed, targets)
 
 
 @xur_announcements.child
@@ -253,5 +284,220 @@ async def manual_xur_announce(ctx: lightbulb.Context):
     await ctx.respond("Xur announcements being sent out now")
 
 
+@kyber.child
+@lightbulb.option(
+    "action",
+    "Send the held announcement out or throw it away",
+    type=str,
+    choices=["Release", "Discard"],
+    required=True,
+)
+@lightbulb.option(
+    "feed",
+    "The held announcement",
+    type=str,
+    choices=[feed.label for feed in Feed],
+    required=True,
+)
+@lightbulb.command(
+    "preflight",
+    "Release or discard an announcement held by pre-flight checks",
+    auto_defer=True,
+    inherit_checks=True,
+)
+@lightbulb.implements(lightbulb.SlashSubCommand)
+async def preflight_override(ctx: lightbulb.Context):
+    feed = {feed.label: feed for feed in Feed}[ctx.options.feed]
+    release = ctx.options.action.lower() == "release"
+    if preflight.decide(feed, release):
+        await ctx.respond(
+            "{} announcement {}".format(
+                feed.label, "released" if release else "discarded"
+            )
+        )
+    else:
+        await ctx.respond("No {} announcement is being held".format(feed.label))
+
+
+@kyber.child
+@lightbulb.option(
+    "reset",
+    "Reset the wait time counters after reading them",
+    type=bool,
+    default=False,
+)
+@lightbulb.command(
+    "db_pool",
+    "Show live database connection pool statistics",
+    auto_defer=True,
+    inherit_checks=True,
+)
+@lightbulb.implements(lightbulb.SlashSubCommand)
+async def db_pool_stats(ctx: lightbulb.Context):
+    await ctx.respond(str(pool_stats))
+    if ctx.options.reset:
+        pool_stats.reset()
+
+
+@kyber.child
+@lightbulb.option(
+    "count",
+    "Number of recent runs to show",
+    type=int,
+    default=5,
+    min_value=1,
+    max_value=20,
+)
+@lightbulb.command(
+    "announce_report",
+    "Show recent announcement runs and how delivery has changed week over week",
+    auto_defer=True,
+    inherit_checks=True,
+)
+@lightbulb.implements(lightbulb.SlashSubCommand)
+async def announce_report(ctx: lightbulb.Context):
+    now = dt.datetime.utcnow()
+    async with db_session() as session:
+        async with session.begin():
+            recent: List[DeliveryRun] = (
+                (
+                    await session.execute(
+                        select(DeliveryRun)
+                        .order_by(DeliveryRun.started_at.desc())
+                        .limit(ctx.options.count)
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            two_weeks: List[DeliveryRun] = (
+                (
+                    await session.execute(
+                        select(DeliveryRun).where(
+                            DeliveryRun.started_at >= now - dt.timedelta(days=14)
+                        )
+                    )
+                )
+                .scalars()
+                .all()
+            )
+    if not recent:
+        await ctx.respond("No announcement runs recorded yet")
+        return
+
+    lines = ["**Latest runs**"]
+    for run in recent:
+        lines.append(
+            "{started} {feeds}: {succeeded}/{channels} delivered, "
+            "{permanent} permanent and {transient} transient failures, "
+            "{rate_limited} 429s, send p50/p95/p99 {p50}/{p95}/{p99}, "
+            "took {wall_time:.1f}s".format(
+                started=run.started_at.strftime("%Y-%m-%d %H:%M"),
+                feeds=", ".join(feed.label for feed in Feed if feed & run.feeds),
+                succeeded=run.succeeded,
+                channels=run.channels,
+                permanent=run.permanent_failures,
+                transient=run.transient_failures,
+                rate_limited=run.rate_limited,
+                p50=_format_seconds(run.send_p50),
+                p95=_format_seconds(run.send_p95),
+                p99=_format_seconds(run.send_p99),
+                wall_time=run.wall_time,
+            )
+        )
+
+    week_ago = now - dt.timedelta(days=7)
+    this_week = [run for run in two_weeks if run.started_at >= week_ago]
+    last_week = [run for run in two_weeks if run.started_at < week_ago]
+    lines.append("")
+    lines.append(
+        "**This week vs last week** ({} vs {} runs)".format(
+            len(this_week), len(last_week)
+        )
+    )
+    for label, value in [
+        ("Channels", lambda run: run.channels),
+        ("Success rate %", lambda run: 100 * run.succeeded / (run.channels or 1)),
+        ("Send p95 (s)", lambda run: run.send_p95),
+        ("Run time (s)", lambda run: run.wall_time),
+        ("429s", lambda run: run.rate_limited),
+    ]:
+        lines.append(
+            "{}: {} vs {}".format(
+                label, _mean(this_week, value), _mean(last_week, value)
+            )
+        )
+    await ctx.respond("\n".join(lines)[:2000])
+
+
+def _format_seconds(seconds) -> str:
+    return "-" if seconds is None else "{:.2f}s".format(seconds)
+
+
+def _mean(runs: List[DeliveryRun], value) -> str:
+    values = [value(run) for run in runs if value(run) is not None]
+    return "-" if not values else "{:.2f}".format(sum(values) / len(values))
+
+
+@kyber.child
+@lightbulb.command(
+    "debug",
+    "Tools for looking into how the bot is running",
+    guilds=[
+        cfg.kyber_discord_server_id,
+    ],
+    inherit_checks=True,
+)
+@lightbulb.implements(lightbulb.SlashSubGroup)
+async def debug():
+    pass
+
+
+@debug.child
+@lightbulb.option(
+    "next_announcement",
+    "Profile the next announcement run instead",
+    type=bool,
+    default=False,
+)
+@lightbulb.option(
+    "seconds",
+    "How long to profile for",
+    type=int,
+    default=30,
+    min_value=1,
+    max_value=600,
+)
+@lightbulb.command(
+    "profile",
+    "Profile the running bot and show where the time goes",
+    auto_defer=True,
+    inherit_checks=True,
+)
+@lightbulb.implements(lightbulb.SlashSubCommand)
+async def debug_profile(ctx: lightbulb.Context):
+    if profiling.is_active():
+        await ctx.respond("A profiling session is already running")
+        return
+    if ctx.options.next_announcement:
+        profiling.profile_next_announcement = True
+        await ctx.respond(
+            "The next announcement run will be profiled, "
+            + "the summary will be in the logs"
+        )
+        return
+
+    await ctx.respond("Profiling for {} seconds".format(ctx.options.seconds))
+    try:
+        result = await profiling.profile_for(ctx.options.seconds)
+    except profiling.ProfilingActiveError:
+        # Another session started while responding
+        await ctx.edit_last_response("A profiling session is already running")
+        return
+    response = "Profile saved to `{}`\n```\n{}".format(result.path, result.summary)
+    # Discord messages are limited to 2000 characters
+    await ctx.edit_last_response(response[:1996] + "\n```")
+
+
 def register_all(bot: lightbulb.BotApp) -> None:
     bot.command(kyber)
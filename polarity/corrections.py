@@ -0,0 +1,134 @@
+# Single-flight correction runs
+# A correction edits the post in every subscribed channel. Running one
+# while another for the same feed is still going would double the REST
+# load and have both race to edit the same posts, so a new correction
+# cancels the one in flight and takes over from it. Posts already showing
+# the new embed, whether from this or an earlier run, aren't edited again.
+
+import asyncio
+import json
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+import hikari
+import lightbulb
+
+from . import cfg
+from .autoannounce import _edit_embedded_message
+from .schemas import Feed
+
+
+class CorrectionTarget(NamedTuple):
+    message_id: int
+    channel_id: int
+    webhook_id: Optional[int] = None
+    webhook_token: Optional[str] = None
+
+
+class _Run:
+    def __init__(self, ctx: lightbulb.Context, embed: hikari.Embed, targets):
+        self.ctx = ctx
+        self.embed = embed
+        self.targets: List[CorrectionTarget] = targets
+        self.done = 0
+        self.task: Optional[asyncio.Task] = None
+
+
+class CorrectionRunner:
+    def __init__(self):
+        self._runs: Dict[Feed, _Run] = {}
+        # What each post was last corrected to, by feed, as serialized embeds
+        self._applied: Dict[Feed, Dict[CorrectionTarget, str]] = {}
+
+    async def correct(
+        self,
+        ctx: lightbulb.Context,
+        feed: Feed,
+        embed: hikari.Embed,
+        targets: List[CorrectionTarget],
+    ) -> None:
+        """Edit the posts for feed in targets to show embed
+
+        Replaces any correction of feed in flight, returns once all posts
+        are corrected or this correction has itself been replaced"""
+        run = _Run(ctx, embed, targets)
+        previous = self._runs.get(feed)
+        self._runs[feed] = run
+        run.task = asyncio.create_task(self._run(feed, run))
+        if previous is not None and not previous.task.done():
+            previous.task.cancel()
+            await _report(
+                previous.ctx,
+                "Replaced by a newer correction after {}/{} posts".format(
+                    previous.done, len(previous.targets)
+                ),
+            )
+        try:
+            await run.task
+        except asyncio.CancelledError:
+            if not run.task.cancelled():
+                # The command itself was cancelled
+                raise
+        finally:
+            if self._runs.get(feed) is run:
+                del self._runs[feed]
+
+    async def _run(self, feed: Feed, run: _Run) -> None:
+        await asyncio.sleep(cfg.correction_debounce)
+
+        signature = json.dumps(
+            run.ctx.bot.entity_factory.serialize_embed(run.embed)[0], sort_keys=True
+        )
+        # Only posts that are still current are kept track of
+        applied = {
+            target: self._applied.get(feed, {}).get(target) for target in run.targets
+        }
+        self._applied[feed] = applied
+        pending = [target for target in run.targets if applied[target] != signature]
+        run.done = len(run.targets) - len(pending)
+        if run.done:
+            logging.info(
+                "{} {} posts are already corrected, skipping them".format(
+                    run.done, feed.label
+                )
+            )
+
+        async def edit(target: CorrectionTarget) -> None:
+            await _edit_embedded_message(
+                target.message_id,
+                target.channel_id,
+                run.ctx.bot,
+                run.embed,
+                target.webhook_id,
+                target.webhook_token,
+            )
+            applied[target] = signature
+            run.done += 1
+
+        progress = asyncio.create_task(self._report_progress(run))
+        try:
+            await asyncio.gather(*[edit(target) for target in pending])
+        finally:
+            progress.cancel()
+        await _report(run.ctx, "Posts corrected")
+
+    async def _report_progress(self, run: _Run) -> None:
+        while True:
+            await asyncio.sleep(cfg.correction_progress_interval)
+            await _report(
+                run.ctx,
+                "Correcting posts, {}/{} done".format(run.done, len(run.targets)),
+            )
+
+
+async def _report(ctx: lightbulb.Context, text: str) -> None:
+    # Interaction responses aren't paced against the global budget, see
+    # rest_lanes.py
+    try:
+        await ctx.edit_last_response(text)
+    except hikari.HTTPError:
+        # Interaction tokens expire after 15 minutes
+        logging.warning("Could not report correction progress: {}".format(text))
+
+
+runner = CorrectionRunner()
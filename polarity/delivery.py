@@ -0,0 +1,670 @@
+# Delivery of announcement embeds to autopost channels
+# Feeds that fire together (e.g. daily and weekly resets on Tuesdays)
+# are coalesced so that each channel gets a single message holding
+# the embeds of all the feeds it is subscribed to. A batch goes out as
+# soon as no other feed is on its way, so a lone feed isn't held back
+
+import asyncio
+import contextlib
+import dataclasses
+import datetime as dt
+import enum
+import functools
+import logging
+import math
+import operator
+import random
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+import hikari
+from sqlalchemy import insert, literal, select, update
+
+from . import cfg, logs, metrics, rest_lanes, tracing
+from .rest_lanes import Lane
+from .schemas import (
+    AutopostSubscription,
+    DeliveryBatch,
+    DeliveryJob,
+    DeliveryRun,
+    Feed,
+)
+from .utils import db_session
+
+# Discord allows at most this many embeds in one message
+MAX_EMBEDS_PER_MESSAGE = 10
+
+
+@dataclasses.dataclass
+class FeedDelivery:
+    feed: Feed
+    embed: hikari.Embed
+    # Monotonic time of the reset being announced, None if announced manually
+    reset_at: Optional[float] = None
+
+
+@dataclasses.dataclass
+class ChannelJob:
+    # Row with the id, feeds, webhook_id and webhook_token of a subscription
+    subscription: Any
+    # Feeds yet to be delivered to the channel
+    deliveries: List[FeedDelivery]
+    attempts: int = 0
+    failure: Optional[BaseException] = None
+
+
+class NotTextableError(Exception):
+    """The subscribed channel can't be posted to, eg. a voice or category
+    channel"""
+
+
+class FailureKind(enum.Enum):
+    # Retrying won't help, eg. missing permissions or a deleted channel
+    PERMANENT = "permanent"
+    # Discord or the connection to it had a problem, may work on retry
+    TRANSIENT = "transient"
+    # Discord asked us to back off for longer than hikari will wait
+    RATE_LIMITED = "rate limited"
+
+
+def classify_failure(exception: BaseException) -> FailureKind:
+    if isinstance(exception, (hikari.RateLimitedError, hikari.RateLimitTooLongError)):
+        return FailureKind.RATE_LIMITED
+    if isinstance(
+        exception,
+        (
+            hikari.InternalServerError,
+            asyncio.TimeoutError,
+            aiohttp.ClientConnectionError,
+            ConnectionError,
+        ),
+    ):
+        return FailureKind.TRANSIENT
+    return FailureKind.PERMANENT
+
+
+@dataclasses.dataclass
+class DeliveryReport:
+    channels: int
+    succeeded: int = 0
+    permanent_failures: int = 0
+    transient_failures: int = 0
+    # 429s from discord while delivering, including those hikari retried
+    rate_limited: int = 0
+    retries: int = 0
+    # Monotonic time of the first successful delivery
+    first_send: Optional[float] = None
+    started_at: dt.datetime = dataclasses.field(default_factory=dt.datetime.utcnow)
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    # Seconds taken by each successful delivery
+    send_latencies: List[float] = dataclasses.field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            "Delivered to {succeeded} of {channels} channels, "
+            + "{permanent_failures} permanent failures, "
+            + "{transient_failures} transient failures after {retries} retries, "
+            + "{rate_limited} 429s"
+        ).format(
+            succeeded=self.succeeded,
+            channels=self.channels,
+            permanent_failures=self.permanent_failures,
+            transient_failures=self.transient_failures,
+            retries=self.retries,
+            rate_limited=self.rate_limited,
+        )
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Send latency below which p percent of deliveries finished"""
+        if not self.send_latencies:
+            return None
+        latencies = sorted(self.send_latencies)
+        # Nearest rank
+        return latencies[max(0, math.ceil(len(latencies) * p / 100) - 1)]
+
+    def to_run(self, feeds: Feed, wall_time: Optional[float] = None) -> DeliveryRun:
+        """The report as a DeliveryRun, wall_time defaults to the time since
+        the report was started"""
+        if wall_time is None:
+            wall_time = time.monotonic() - self.started
+        return DeliveryRun(
+            started_at=self.started_at,
+            feeds=int(feeds),
+            channels=self.channels,
+            succeeded=self.succeeded,
+            permanent_failures=self.permanent_failures,
+            transient_failures=self.transient_failures,
+            rate_limited=self.rate_limited,
+            send_p50=self.percentile(50),
+            send_p95=self.percentile(95),
+            send_p99=self.percentile(99),
+            wall_time=wall_time,
+        )
+
+    async def save(self, feeds: Feed) -> None:
+        async with db_session() as session:
+            async with session.begin():
+                session.add(self.to_run(feeds))
+
+
+class DeliveryCoalescer:
+    def __init__(self, window: float = cfg.delivery_coalesce_window):
+        self.window = window
+        self._pending: List[FeedDelivery] = []
+        self._flush: Optional[asyncio.Task] = None
+        # Set once every feed on its way has been submitted
+        self._ready: Optional[asyncio.Event] = None
+        # Feeds being prepared for delivery -> number of announcers preparing them
+        self._expected: Dict[Feed, int] = defaultdict(int)
+
+    @contextlib.contextmanager
+    def expecting(self, feed: Feed):
+        """Mark feed as on its way for the enclosed block
+
+        A batch is delivered as soon as every feed on its way has been
+        submitted, and waits up to the window for the others otherwise"""
+        self._expected[feed] += 1
+        try:
+            yield
+        finally:
+            self._expected[feed] -= 1
+            if not self._expected[feed]:
+                del self._expected[feed]
+            self._check_ready()
+
+    async def deliver(self, bot: hikari.GatewayBot, delivery: FeedDelivery) -> None:
+        """Queue a feed for delivery, returns once it has been delivered"""
+        self._pending.append(delivery)
+        if self._flush is None:
+            self._ready = asyncio.Event()
+            self._flush = asyncio.create_task(self._flush_when_ready(bot))
+        self._check_ready()
+        # Shielded so one cancelled announcer doesn't cancel the others
+        await asyncio.shield(self._flush)
+
+    def _check_ready(self) -> None:
+        if self._ready is not None and set(self._expected) <= {
+            d.feed for d in self._pending
+        }:
+            self._ready.set()
+
+    async def _flush_when_ready(self, bot: hikari.GatewayBot) -> None:
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.window)
+        except asyncio.TimeoutError:
+            logging.info(
+                "Delivering without {}, it wasn't ready within {}s".format(
+                    ", ".join(
+                        feed.label
+                        for feed in self._expected
+                        if feed not in {d.feed for d in self._pending}
+                    ),
+                    self.window,
+                )
+            )
+        batch, self._pending, self._flush = self._pending, [], None
+        self._ready = None
+        with tracing.span("deliver", embeds=len(batch)):
+            await self._deliver_batch(bot, batch)
+
+    async def _deliver_batch(
+        self, bot: hikari.GatewayBot, batch: List[FeedDelivery]
+    ) -> None:
+        # A feed submitted twice in a window is only delivered once
+        feed_deliveries: Dict[Feed, FeedDelivery] = {d.feed: d for d in batch}
+        batch = [feed_deliveries[feed] for feed in sorted(feed_deliveries)]
+        feeds = functools.reduce(operator.or_, feed_deliveries, Feed(0))
+
+        await _announce_to_followers(bot, batch)
+
+        if cfg.delivery_worker:
+            await _enqueue_deliveries(bot, batch, feeds)
+            return
+
+        # One scan finds the channels for every feed in the batch
+        with tracing.span("scan") as span:
+            subscriptions = await _subscribers(feeds)
+            span.set_attributes(channels=len(subscriptions))
+
+        logging.info(
+            "Delivering {} feeds to {} channels".format(len(batch), len(subscriptions))
+        )
+        report = DeliveryReport(len(subscriptions))
+        jobs = [
+            ChannelJob(subscription, [d for d in batch if d.feed & subscription.feeds])
+            for subscription in subscriptions
+        ]
+        with tracing.span("main pass", channels=len(jobs)):
+            retry = await asyncio.gather(
+                *[_attempt_delivery(bot, job, report) for job in jobs]
+            )
+        # Failures that may go away are retried after everyone else
+        # has had their post, so they don't hold up the main pass
+        retry_jobs = [job for job, retry_ in zip(jobs, retry) if retry_]
+        with tracing.span("retries", channels=len(retry_jobs)):
+            await _retry_deliveries(bot, retry_jobs, report)
+        logging.info(str(report))
+        await report.save(feeds)
+        tracing.current_span().set_attributes(
+            succeeded=report.succeeded,
+            permanent_failures=report.permanent_failures,
+            transient_failures=report.transient_failures,
+            rate_limited=report.rate_limited,
+        )
+        _record_reset_latency(batch, report)
+
+
+def _record_reset_latency(batch: List[FeedDelivery], report: DeliveryReport) -> None:
+    resets = [d.reset_at for d in batch if d.reset_at is not None]
+    if not resets or report.first_send is None:
+        # Announced manually or nothing was delivered
+        return
+    reset_at = min(resets)
+    label = ",".join(d.feed.name.lower() for d in batch)
+    metrics.reset_first_send.observe(report.first_send - reset_at, feeds=label)
+    metrics.reset_last_send.observe(time.monotonic() - reset_at, feeds=label)
+
+
+coalescer = DeliveryCoalescer()
+
+
+async def _enqueue_deliveries(
+    bot: hikari.GatewayBot, batch: List[FeedDelivery], feeds: Feed
+) -> None:
+    """Queue a job per subscribed channel for the delivery workers"""
+    embeds = [
+        {"feed": int(d.feed), "embed": bot.entity_factory.serialize_embed(d.embed)[0]}
+        for d in batch
+    ]
+    with tracing.span("enqueue"):
+        async with db_session() as session:
+            async with session.begin():
+                delivery_batch = DeliveryBatch(embeds)
+                session.add(delivery_batch)
+                await session.flush()
+                # Jobs are made in the db from the subscriptions directly
+                # rather than by round tripping every channel through here
+                result = await session.execute(
+                    insert(DeliveryJob).from_select(
+                        ["batch_id", "channel_id", "feeds"],
+                        select(
+                            literal(delivery_batch.id),
+                            AutopostSubscription.id,
+                            AutopostSubscription.feeds.op("&")(int(feeds)),
+                        ).where(
+                            AutopostSubscription.subscribed_to(feeds),
+                            AutopostSubscription.not_quarantined(),
+                        ),
+                    )
+                )
+                delivery_batch.channels = result.rowcount
+    logging.info(
+        "Queued {} feeds for delivery to {} channels".format(
+            len(batch), result.rowcount
+        )
+    )
+
+
+async def _subscribers(feeds: Feed) -> list:
+    """Channels to deliver any of feeds to, as rows of their id, feeds and
+    webhook"""
+    async with db_session() as session:
+        async with session.begin():
+            return (
+                await session.execute(
+                    select(
+                        AutopostSubscription.id,
+                        AutopostSubscription.feeds,
+                        AutopostSubscription.webhook_id,
+                        AutopostSubscription.webhook_token,
+                    ).where(
+                        AutopostSubscription.subscribed_to(feeds),
+                        AutopostSubscription.not_quarantined(),
+                    )
+                )
+            ).fetchall()
+
+
+async def _announce_to_followers(
+    bot: hikari.GatewayBot, deliveries: List[FeedDelivery]
+) -> None:
+    """Post feeds once to their announcement channels in the Kyber server
+    and publish the posts, discord delivers them to all followers"""
+    channel_deliveries: Dict[int, List[FeedDelivery]] = defaultdict(list)
+    for delivery in deliveries:
+        if delivery.feed.announce_channel_id is not None:
+            channel_deliveries[delivery.feed.announce_channel_id].append(delivery)
+
+    for channel_id, deliveries in channel_deliveries.items():
+        try:
+            await rest_lanes.acquire(Lane.ADMIN)
+            message = await bot.rest.create_message(
+                channel_id, embeds=[d.embed for d in deliveries]
+            )
+            await rest_lanes.acquire(Lane.ADMIN)
+            await bot.rest.crosspost_message(channel_id, message)
+        except hikari.HTTPError:
+            logging.exception(
+                "Could not publish to announcement channel {}".format(channel_id)
+            )
+            continue
+        async with db_session() as session:
+            async with session.begin():
+                for delivery in deliveries:
+                    settings_table = delivery.feed.settings_table
+                    await session.execute(
+                        update(settings_table)
+                        .where(settings_table.id == 0)
+                        .values(announce_msg_id=message.id)
+                    )
+
+
+async def _attempt_delivery(
+    bot: hikari.GatewayBot, job: ChannelJob, report: DeliveryReport
+) -> bool:
+    """Try to deliver a job, returns whether it should be retried"""
+    job.attempts += 1
+    start = time.monotonic()
+    # 429s hikari retries while sending are counted in the report too
+    token = metrics.rate_limit_report.set(report)
+    try:
+        await _send_embeds_if_textable_channel(bot, job)
+    except Exception as e:
+        job.failure = e
+    else:
+        report.succeeded += 1
+        report.send_latencies.append(time.monotonic() - start)
+        if report.first_send is None:
+            report.first_send = time.monotonic()
+        return False
+    finally:
+        metrics.rate_limit_report.reset(token)
+
+    kind = classify_failure(job.failure)
+    if kind is FailureKind.RATE_LIMITED:
+        report.rate_limited += 1
+        metrics.rate_limited.inc(outcome="raised")
+    if kind is FailureKind.PERMANENT:
+        report.permanent_failures += 1
+        await _handle_permanent_failure(job)
+        return False
+    if job.attempts >= cfg.delivery_max_attempts:
+        report.transient_failures += 1
+        logging.warning(
+            "Giving up on channel {} after {} attempts: {!r}".format(
+                job.subscription.id, job.attempts, job.failure
+            ),
+            extra=logs.aggregate(
+                "channels given up on", channel_id=job.subscription.id
+            ),
+        )
+        await _record_transient_failure(job.subscription.id)
+        return False
+    return True
+
+
+async def _retry_deliveries(
+    bot: hikari.GatewayBot, jobs: List[ChannelJob], report: DeliveryReport
+) -> None:
+    if not jobs:
+        return
+    logging.info("Retrying delivery to {} channels".format(len(jobs)))
+    # Retries run with less concurrency than the main pass
+    semaphore = asyncio.Semaphore(cfg.delivery_retry_concurrency)
+
+    async def retry(job: ChannelJob) -> None:
+        while True:
+            await asyncio.sleep(_backoff(job))
+            async with semaphore:
+                report.retries += 1
+                if not await _attempt_delivery(bot, job, report):
+                    return
+
+    await asyncio.gather(*[retry(job) for job in jobs])
+
+
+def _backoff(job: ChannelJob) -> float:
+    # Capped exponential backoff with jitter so retries don't all land
+    # at the same moment, never sooner than discord asked us to wait
+    delay = min(
+        cfg.delivery_retry_max_delay,
+        cfg.delivery_retry_base_delay * 2 ** (job.attempts - 1),
+    )
+    delay = random.uniform(delay / 2, delay)
+    return max(delay, getattr(job.failure, "retry_after", 0) or 0)
+
+
+async def _handle_permanent_failure(job: ChannelJob) -> None:
+    channel_id = job.subscription.id
+    if not isinstance(
+        job.failure, (hikari.ForbiddenError, hikari.NotFoundError, NotTextableError)
+    ):
+        logging.error(
+            "Could not deliver to channel {}".format(channel_id),
+            exc_info=job.failure,
+            extra=logs.aggregate(
+                "channels failed with unexpected errors", channel_id=channel_id
+            ),
+        )
+        return
+    feeds = functools.reduce(operator.or_, [d.feed for d in job.deliveries], Feed(0))
+    logging.warning(
+        "Channel {} not found or not messageable, disabling {} posts".format(
+            channel_id, ", ".join(d.feed.label for d in job.deliveries)
+        ),
+        extra=logs.aggregate("channels disabled", channel_id=channel_id),
+    )
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                update(AutopostSubscription)
+                .where(AutopostSubscription.id == channel_id)
+                .values(feeds=AutopostSubscription.feeds.op("&")(~int(feeds)))
+            )
+
+
+async def _record_transient_failure(channel_id: int) -> None:
+    # Channels that keep failing are skipped for a while so they
+    # don't slow down every reset
+    async with db_session() as session:
+        async with session.begin():
+            subscription = await session.get(AutopostSubscription, channel_id)
+            if subscription is None:
+                return
+            now = dt.datetime.utcnow()
+            if (
+                subscription.quarantined_until is not None
+                and subscription.quarantined_until <= now
+            ):
+                # The quarantine has run out, the channel starts over rather
+                # than being quarantined again by its next failure
+                subscription.failure_count = 0
+                subscription.quarantined_until = None
+            subscription.failure_count = (subscription.failure_count or 0) + 1
+            if subscription.failure_count >= cfg.delivery_quarantine_after:
+                subscription.quarantined_until = now + dt.timedelta(
+                    hours=cfg.delivery_quarantine_hours
+                )
+                logging.warning(
+                    "Quarantining channel {} until {} after {} failed runs".format(
+                        channel_id,
+                        subscription.quarantined_until,
+                        subscription.failure_count,
+                    ),
+                    extra=logs.aggregate("channels quarantined", channel_id=channel_id),
+                )
+
+
+async def _send_embeds_if_textable_channel(
+    bot: hikari.GatewayBot, job: ChannelJob
+) -> None:
+    channel_id = job.subscription.id
+    webhook_id = job.subscription.webhook_id
+    channel = None
+    while job.deliveries:
+        chunk = job.deliveries[:MAX_EMBEDS_PER_MESSAGE]
+        with tracing.span(
+            "send chunk", channel_id=channel_id, embeds=len(chunk), webhook=False
+        ) as span:
+            embeds = [d.embed for d in chunk]
+            message_id = None
+            if webhook_id is not None:
+                span.set_attributes(webhook=True)
+                message_id = await _execute_webhook(
+                    bot, channel_id, webhook_id, job.subscription.webhook_token, embeds
+                )
+                if message_id is None:
+                    # Webhook is gone, use the bot for the rest
+                    webhook_id = None
+            if message_id is None:
+                if channel is None:
+                    await rest_lanes.acquire(Lane.BULK)
+                    channel = await bot.rest.fetch_channel(channel_id)
+                # Can add hikari.GuildNewsChannel for announcement channel support
+                # could be useful if we automate more stuff for Kyber
+                if not isinstance(channel, hikari.TextableChannel):
+                    raise NotTextableError(
+                        "Channel {} is not a text channel".format(channel_id)
+                    )
+                await rest_lanes.acquire(Lane.BULK)
+                with metrics.rest_send.time(kind="channel"):
+                    message = await bot.rest.create_message(channel_id, embeds=embeds)
+                message_id = message.id
+        # Delivered feeds are dropped so a retry only sends what's left
+        del job.deliveries[: len(chunk)]
+        with tracing.span("db flush", channel_id=channel_id):
+            await _record_delivered(
+                channel_id, {d.feed.msg_id_column: message_id for d in chunk}
+            )
+
+
+async def _record_delivered(channel_id: int, message_ids: Dict[str, int]) -> None:
+    # message_ids maps the msg_id_column of each delivered feed to the id of
+    # the message it went out in
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                update(AutopostSubscription)
+                .where(AutopostSubscription.id == channel_id)
+                .values(failure_count=0, **message_ids)
+            )
+
+
+async def _execute_webhook(
+    bot: hikari.GatewayBot,
+    channel_id: int,
+    webhook_id: int,
+    webhook_token: str,
+    embeds: List[hikari.Embed],
+) -> Optional[int]:
+    """Post embeds through a channel's webhook, returns the message's id
+
+    Returns None and forgets the webhook if it has been deleted"""
+    # Make webhook posts look like the bot's own
+    me = bot.get_me()
+    username = me.username if me else hikari.UNDEFINED
+    avatar_url = me.avatar_url if me and me.avatar_url else hikari.UNDEFINED
+    # Webhooks have their own rate limits rather than the bot's global
+    # one, so these skip the REST lanes
+    try:
+        with metrics.rest_send.time(kind="webhook"):
+            message = await bot.rest.execute_webhook(
+                webhook_id,
+                webhook_token,
+                embeds=embeds,
+                username=username,
+                avatar_url=avatar_url,
+            )
+        return message.id
+    except (hikari.NotFoundError, hikari.UnauthorizedError):
+        logging.warning(
+            "Webhook for channel {} is gone, falling back to bot sends".format(
+                channel_id
+            ),
+            extra=logs.aggregate("channel webhooks gone", channel_id=channel_id),
+        )
+        await _forget_webhook(channel_id)
+        return None
+
+
+async def _forget_webhook(channel_id: int) -> None:
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                update(AutopostSubscription)
+                .where(AutopostSubscription.id == channel_id)
+                .values(webhook_id=None, webhook_token=None)
+            )
+
+
+# The webhook functions below call discord outside of any transaction, so
+# no pool connection is held while waiting on it
+
+
+async def create_delivery_webhook(bot: hikari.GatewayBot, channel_id: int) -> None:
+    """Create a webhook to deliver autoposts to a subscribed channel
+
+    Leaves the subscription on bot sends if the channel can't have
+    webhooks (dms, threads) or the bot may not manage them there"""
+    async with db_session() as session:
+        async with session.begin():
+            subscription = await session.get(AutopostSubscription, channel_id)
+            if subscription is None or subscription.webhook_id is not None:
+                return
+    await rest_lanes.acquire(Lane.ADMIN)
+    channel = await bot.rest.fetch_channel(channel_id)
+    if not isinstance(channel, (hikari.GuildTextChannel, hikari.GuildNewsChannel)):
+        return
+    try:
+        await rest_lanes.acquire(Lane.ADMIN)
+        webhook = await bot.rest.create_webhook(
+            channel, "Autoposts", reason="Autopost delivery"
+        )
+    except hikari.ForbiddenError:
+        logging.info(
+            "No permission to create a webhook in {}, using bot sends".format(
+                channel_id
+            )
+        )
+        return
+    saved = False
+    try:
+        async with db_session() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(AutopostSubscription)
+                    .where(
+                        AutopostSubscription.id == channel_id,
+                        AutopostSubscription.webhook_id.is_(None),
+                    )
+                    .values(webhook_id=webhook.id, webhook_token=webhook.token)
+                )
+                saved = result.rowcount == 1
+    finally:
+        # Don't leave a webhook behind that nothing knows about, when
+        # saving failed or another request gave the channel one meanwhile
+        if not saved:
+            await _delete_webhook(bot, webhook.id)
+
+
+async def delete_delivery_webhook(bot: hikari.GatewayBot, channel_id: int) -> None:
+    async with db_session() as session:
+        async with session.begin():
+            subscription = await session.get(AutopostSubscription, channel_id)
+            if subscription is None or subscription.webhook_id is None:
+                return
+            webhook_id = subscription.webhook_id
+            subscription.webhook_id = None
+            subscription.webhook_token = None
+    # Forgotten first, so the channel is never left on a deleted webhook
+    await _delete_webhook(bot, webhook_id)
+
+
+async def _delete_webhook(bot: hikari.GatewayBot, webhook_id: int) -> None:
+    try:
+        await rest_lanes.acquire(Lane.ADMIN)
+        await bot.rest.delete_webhook(webhook_id)
+    except (hikari.ForbiddenError, hikari.NotFoundError):
+        pass
@@ -0,0 +1,264 @@
+# Standalone REST only delivery worker
+# With cfg.delivery_worker set, the bot queues a DeliveryJob per channel
+# on every reset instead of sending announcements from the process that
+# holds the gateway connection. Any number of these workers take jobs from
+# that queue with SELECT ... FOR UPDATE SKIP LOCKED and deliver them, so
+# delivery can be scaled and restarted without touching the bot.
+# Jobs are claimed in a short transaction that leases them by pushing back
+# their available_at, and are sent once that is committed, so no
+# transaction or connection is held while waiting on discord. Jobs of a
+# worker that dies are taken up again by others once the lease runs out.
+# Run with: python -m polarity.delivery_worker
+
+import asyncio
+import datetime as dt
+import functools
+import logging
+import operator
+from typing import Dict, List
+
+import hikari
+import uvloop
+from sqlalchemy import delete, exists, select, update
+
+from . import cfg, logs, metrics, rest_lanes, tracing
+from .delivery import (
+    ChannelJob,
+    DeliveryReport,
+    FeedDelivery,
+    _attempt_delivery,
+    _backoff,
+)
+from .rest_lanes import Lane, LaneLimiter
+from .schemas import AutopostSubscription, DeliveryBatch, DeliveryJob, Feed
+from .utils import db_session
+
+rest = hikari.RESTApp()
+
+# Batches are kept for a while after their last job is done
+BATCH_RETENTION = dt.timedelta(days=7)
+
+
+class _RESTOnlyBot:
+    # Just what the delivery functions need from a bot
+    def __init__(self, client: hikari.api.RESTClient, me: hikari.OwnUser):
+        self.rest = client
+        self.entity_factory = client.entity_factory
+        self._me = me
+
+    def get_me(self) -> hikari.OwnUser:
+        return self._me
+
+
+async def _load_batch(
+    session, batches: Dict[int, List[FeedDelivery]], bot: _RESTOnlyBot, batch_id: int
+) -> List[FeedDelivery]:
+    if batch_id not in batches:
+        batch: DeliveryBatch = await session.get(DeliveryBatch, batch_id)
+        batches[batch_id] = [
+            FeedDelivery(
+                Feed(item["feed"]),
+                bot.entity_factory.deserialize_embed(item["embed"]),
+            )
+            for item in batch.embeds
+        ]
+    return batches[batch_id]
+
+
+async def process_jobs(
+    bot: _RESTOnlyBot,
+    batches: Dict[int, List[FeedDelivery]],
+):
+    """Take and deliver one lot of jobs, returns the number of jobs taken"""
+    async with db_session() as session:
+        async with session.begin():
+            now = dt.datetime.utcnow()
+            rows = (
+                await session.execute(
+                    select(
+                        DeliveryJob.id.label("job_id"),
+                        DeliveryJob.batch_id,
+                        DeliveryJob.attempts,
+                        DeliveryJob.channel_id.label("id"),
+                        DeliveryJob.feeds,
+                        AutopostSubscription.webhook_id,
+                        AutopostSubscription.webhook_token,
+                    )
+                    .outerjoin(
+                        AutopostSubscription,
+                        AutopostSubscription.id == DeliveryJob.channel_id,
+                    )
+                    .where(DeliveryJob.available_at <= now)
+                    .order_by(DeliveryJob.id)
+                    .limit(cfg.delivery_worker_batch_size)
+                    # Other workers skip these rows while they are being
+                    # leased rather than wait for them
+                    .with_for_update(of=DeliveryJob, skip_locked=True)
+                )
+            ).fetchall()
+            if not rows:
+                return 0
+            await session.execute(
+                update(DeliveryJob)
+                .where(DeliveryJob.id.in_([row.job_id for row in rows]))
+                .values(
+                    available_at=now + dt.timedelta(seconds=cfg.delivery_worker_lease)
+                )
+            )
+            jobs = [
+                ChannelJob(
+                    row,
+                    [
+                        d
+                        for d in await _load_batch(session, batches, bot, row.batch_id)
+                        if d.feed & row.feeds
+                    ],
+                    attempts=row.attempts,
+                )
+                for row in rows
+            ]
+
+    # The lot's part in each batch's run
+    reports: Dict[int, DeliveryReport] = {}
+    for row in rows:
+        reports.setdefault(row.batch_id, DeliveryReport(0)).channels += 1
+    with tracing.span("Delivery worker jobs", jobs=len(jobs)):
+        retry = await asyncio.gather(
+            *[
+                _attempt_delivery(bot, job, reports[row.batch_id])
+                for row, job in zip(rows, jobs)
+            ]
+        )
+
+    async with db_session() as session:
+        async with session.begin():
+            # Locked in id order so workers finishing the same batches wait
+            # on each other rather than deadlock
+            delivery_batches = [
+                await session.get(DeliveryBatch, batch_id, with_for_update=True)
+                for batch_id in sorted(reports)
+            ]
+            done = [row.job_id for row, retry_ in zip(rows, retry) if not retry_]
+            if done:
+                await session.execute(
+                    delete(DeliveryJob).where(DeliveryJob.id.in_(done))
+                )
+            for row, job, retry_ in zip(rows, jobs, retry):
+                if not retry_:
+                    continue
+                # Left in the queue with only what is still to be delivered
+                await session.execute(
+                    update(DeliveryJob)
+                    .where(DeliveryJob.id == row.job_id)
+                    .values(
+                        attempts=job.attempts,
+                        feeds=int(
+                            functools.reduce(
+                                operator.or_, [d.feed for d in job.deliveries], Feed(0)
+                            )
+                        ),
+                        available_at=dt.datetime.utcnow()
+                        + dt.timedelta(seconds=_backoff(job)),
+                    )
+                )
+            for delivery_batch in delivery_batches:
+                await _add_to_run(session, delivery_batch, reports[delivery_batch.id])
+    for report in reports.values():
+        logging.info(str(report))
+    return len(rows)
+
+
+async def _add_to_run(
+    session, delivery_batch: DeliveryBatch, report: DeliveryReport
+) -> None:
+    # Adds a lot's report to its batch's totals, the worker that finishes the
+    # batch's last job saves them as the batch's one DeliveryRun. The batch
+    # row is locked, so no other worker is finishing jobs of it meanwhile
+    delivery_batch.succeeded += report.succeeded
+    delivery_batch.permanent_failures += report.permanent_failures
+    delivery_batch.transient_failures += report.transient_failures
+    delivery_batch.rate_limited += report.rate_limited
+    delivery_batch.send_latencies = (
+        delivery_batch.send_latencies + report.send_latencies
+    )
+    await session.flush()
+    if (
+        await session.execute(
+            select(exists().where(DeliveryJob.batch_id == delivery_batch.id))
+        )
+    ).scalar():
+        return
+    total = DeliveryReport(
+        delivery_batch.channels,
+        succeeded=delivery_batch.succeeded,
+        permanent_failures=delivery_batch.permanent_failures,
+        transient_failures=delivery_batch.transient_failures,
+        rate_limited=delivery_batch.rate_limited,
+        started_at=delivery_batch.created_at,
+        send_latencies=delivery_batch.send_latencies,
+    )
+    feeds = functools.reduce(
+        operator.or_, [Feed(item["feed"]) for item in delivery_batch.embeds], Feed(0)
+    )
+    session.add(
+        total.to_run(
+            feeds,
+            wall_time=(
+                dt.datetime.utcnow() - delivery_batch.created_at
+            ).total_seconds(),
+        )
+    )
+    logging.info("Batch {}: {}".format(delivery_batch.id, total))
+
+
+async def _delete_old_batches() -> None:
+    async with db_session() as session:
+        async with session.begin():
+            await session.execute(
+                delete(DeliveryBatch).where(
+                    DeliveryBatch.created_at < dt.datetime.utcnow() - BATCH_RETENTION,
+                    ~exists().where(DeliveryJob.batch_id == DeliveryBatch.id),
+                )
+            )
+
+
+async def run(client: hikari.api.RESTClient) -> None:
+    bot = _RESTOnlyBot(client, await client.fetch_my_user())
+    # Deserialized batches by id
+    batches: Dict[int, List[FeedDelivery]] = {}
+    logging.info("Delivery worker started")
+    failures = 0
+    while True:
+        try:
+            if not await process_jobs(bot, batches):
+                await _delete_old_batches()
+                batches.clear()
+                await asyncio.sleep(cfg.delivery_worker_poll_interval)
+            failures = 0
+        except Exception:
+            # Jobs taken by the failed lot are taken up again once their
+            # lease runs out, the worker carries on after backing off
+            failures += 1
+            delay = min(60, cfg.delivery_worker_poll_interval * 2**failures)
+            logging.exception(
+                "Delivery worker failed, retrying in {:.0f}s".format(delay)
+            )
+            await asyncio.sleep(delay)
+
+
+async def main() -> None:
+    logs.setup()
+    metrics.watch_rate_limits()
+    # The bot process keeps the admin share of the global budget, all
+    # bulk traffic happens here, split evenly between the workers
+    rest_lanes.limiter = LaneLimiter(
+        cfg.rest_global_rate * (1 - cfg.rest_admin_share) / cfg.delivery_worker_count,
+        {Lane.BULK: 1},
+    )
+    async with rest.acquire(cfg.main_token, hikari.TokenType.BOT) as client:
+        await run(client)
+
+
+if __name__ == "__main__":
+    uvloop.install()
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+# Logging setup
+# Log calls only put records on a queue, a listener thread formats and
+# writes them, so a burst of per channel warnings during fan-out doesn't
+# block the event loop on I/O. Records are written as JSON lines with any
+# extra fields kept as keys. Records logged with extra=aggregate(key) are
+# counted rather than written, and each window a single summary line is
+# written per key, e.g. "412 channels disabled" instead of 412 lines.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, Optional
+
+from . import cfg
+
+# Attributes every LogRecord has, anything else was passed in extra
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def aggregate(key: str, **fields) -> dict:
+    """extra for a log call that should be summed up with others like it
+
+    key says what is being counted, like channels disabled"""
+    return {"aggregate": key, **fields}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRS
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _Aggregate:
+    def __init__(self, record: logging.LogRecord):
+        self.count = 0
+        # Kept as an example in the summary
+        self.record = record
+
+
+class AggregatingHandler(logging.Handler):
+    """Passes records on to target, summing up those with an aggregate key"""
+
+    def __init__(self, target: logging.Handler, window: float):
+        super().__init__()
+        self.target = target
+        self.window = window
+        self._aggregates: Dict[str, _Aggregate] = {}
+        self._aggregates_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="log-aggregator", daemon=True
+        )
+        self._flusher.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        key = getattr(record, "aggregate", None)
+        if key is None:
+            self.target.handle(record)
+            return
+        with self._aggregates_lock:
+            if key not in self._aggregates:
+                self._aggregates[key] = _Aggregate(record)
+            self._aggregates[key].count += 1
+
+    def _flush_periodically(self) -> None:
+        while not self._stop.wait(self.window):
+            self.flush_aggregates()
+
+    def flush_aggregates(self) -> None:
+        with self._aggregates_lock:
+            aggregates, self._aggregates = self._aggregates, {}
+        for key, aggregate in aggregates.items():
+            example = aggregate.record
+            summary = logging.makeLogRecord(vars(example))
+            summary.msg = "{} {} in the last {:g}s, e.g. {}".format(
+                aggregate.count, key, self.window, example.getMessage()
+            )
+            summary.args = None
+            summary.created = time.time()
+            summary.msecs = (summary.created % 1) * 1000
+            summary.count = aggregate.count
+            self.target.handle(summary)
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush_aggregates()
+        self.target.close()
+        super().close()
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup(level: str = cfg.log_level) -> None:
+    """Send all logging through the queue, call once at startup"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler()
+    if cfg.log_json:
+        output.setFormatter(JSONFormatter())
+    else:
+        output.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(
+        log_queue, AggregatingHandler(output, cfg.log_aggregate_window)
+    )
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    _listener.start()
+    atexit.register(_shutdown)
+
+
+def _shutdown() -> None:
+    # Writes out whatever is still queued or being aggregated
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
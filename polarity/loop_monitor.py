@@ -0,0 +1,78 @@
+# Event loop health monitor
+# A synchronous call inside a coroutine (like a gspread fetch made on the
+# loop rather than in a thread) stalls everything on the loop, gateway heartbeats
+# included. With cfg.loop_monitor_enabled, a task on the loop wakes up every
+# cfg.loop_monitor_interval seconds and records how late it was woken as
+# scheduling lag. A watchdog thread checks that the task keeps waking up and,
+# when it hasn't for cfg.loop_lag_threshold seconds, logs the stack the loop
+# is stuck in, once per stall.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from . import cfg, metrics
+
+lag = metrics.Histogram(
+    "polarity_loop_lag_seconds",
+    "How late the event loop ran a callback scheduled on it",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+stalls = metrics.Counter(
+    "polarity_loop_stalls_total",
+    "Times the event loop was blocked for longer than the lag threshold",
+)
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        # Monotonic time the loop last ran the monitor task
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._measure())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+        logging.info(
+            "Loop monitor started, reporting stalls over {}s".format(self.threshold)
+        )
+
+    async def _measure(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            lag.observe(max(0.0, self._heartbeat - expected))
+
+    def _watch(self) -> None:
+        # Runs in its own thread, so it still runs while the loop is blocked
+        reported = None
+        while self._task is not None and not self._task.done():
+            time.sleep(self.interval)
+            heartbeat = self._heartbeat
+            if heartbeat == reported:
+                continue
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.threshold:
+                continue
+            reported = heartbeat
+            stalls.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unknown"
+            logging.warning(
+                "Event loop blocked for over {:.2f}s, in:\n{}".format(
+                    blocked_for, stack
+                )
+            )
+
+
+monitor = LoopMonitor(cfg.loop_monitor_interval, cfg.loop_lag_threshold)
@@ -3,19 +3,39 @@ import lightbulb
 import uvloop
 from lightbulb.ext import tasks
 
-from . import cfg, controller, debug_commands, user_commands
+from . import (
+    cfg,
+    controller,
+    debug_commands,
+    logs,
+    loop_monitor,
+    user_commands,
+    warmup,
+)
 from .autoannounce import arm
 
 # Note: Alembic's env.py is set up to import Base from polarity.main
 from .schemas import Base
+from .utils import close_http_session
 
-uvloop.install()
 bot: lightbulb.BotApp = lightbulb.BotApp(**cfg.lightbulb_params)
 
 
+@bot.listen(hikari.StartingEvent)
+async def on_starting(event: hikari.StartingEvent) -> None:
+    await warmup.warm_up(event)
+
+
 @bot.listen(hikari.StartedEvent)
 async def on_ready(event: hikari.StartedEvent) -> None:
     await arm(bot)
+    if cfg.loop_monitor_enabled:
+        loop_monitor.monitor.start()
+
+
+@bot.listen(hikari.StoppingEvent)
+async def on_stopping(event: hikari.StoppingEvent) -> None:
+    await close_http_session()
 
 
 @tasks.task(m=30, auto_start=True, wait_before_execution=False)
@@ -30,6 +50,8 @@ async def autoupdate_status():
 
 
 if __name__ == "__main__":
+    uvloop.install()
+    logs.setup()
     user_commands.register_all(bot)
     controller.register_all(bot)
     tasks.load(bot)
@@ -0,0 +1,248 @@
+# Prometheus style metrics
+# Counters and histograms kept in process and served in the Prometheus text
+# format at /metrics on the web app in autoannounce.py, so production
+# resets can be scraped and compared over time. Kept to the few pieces the
+# bot needs rather than pulling in a client library.
+
+import abc
+import bisect
+import contextlib
+import contextvars
+import datetime as dt
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import lightbulb
+from aiohttp import web
+
+# Seconds, from fast REST calls up to a slow reset run
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+)
+
+_registry: List["_Metric"] = []
+
+
+class _Metric(abc.ABC):
+    type_ = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [
+            '{}="{}"'.format(label, _escape(value))
+            for label, value in zip(self.labels, key)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        """Sample lines of the metric in the text format"""
+
+    def render(self) -> str:
+        return "\n".join(
+            [
+                "# HELP {} {}".format(self.name, self.documentation),
+                "# TYPE {} {}".format(self.name, self.type_),
+            ]
+            + self._samples()
+        )
+
+
+class Counter(_Metric):
+    type_ = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        self._values[self._key(labels)] += amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [
+            "{}{} {}".format(self.name, self._label_text(key), value)
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    type_ = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: count in each bucket (not cumulative), sum, count
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        if key not in self._counts:
+            self._counts[key] = [0] * (len(self.buckets) + 1)
+        self._counts[key][bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        self._label_text(key, 'le="{}"'.format(_format_bound(bound))),
+                        cumulative,
+                    )
+                )
+            samples.append(
+                "{}_sum{} {}".format(self.name, self._label_text(key), self._sums[key])
+            )
+            samples.append(
+                "{}_count{} {}".format(self.name, self._label_text(key), cumulative)
+            )
+        return samples
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+reset_first_send = Histogram(
+    "polarity_reset_first_send_seconds",
+    "Time from the reset signal to the first announcement delivered",
+    ["feeds"],
+)
+reset_last_send = Histogram(
+    "polarity_reset_last_send_seconds",
+    "Time from the reset signal to the last announcement delivered",
+    ["feeds"],
+)
+rest_send = Histogram(
+    "polarity_rest_send_seconds",
+    "Time taken by each announcement send, including rate limit waits",
+    ["kind"],
+)
+rate_limited = Counter(
+    "polarity_rate_limited_total",
+    "429 responses from discord, by whether hikari retried them or raised",
+    ["outcome"],
+)
+db_pool_wait = Histogram(
+    "polarity_db_pool_wait_seconds",
+    "Time spent waiting for a database connection from the pool",
+)
+redirect_cache_requests = Counter(
+    "polarity_redirect_cache_requests_total",
+    "Link redirect lookups, by whether the cache had them",
+    ["result"],
+)
+sheets_fetch = Histogram(
+    "polarity_sheets_fetch_seconds",
+    "Time taken to fetch a rotation from Google Sheets",
+)
+interaction_response = Histogram(
+    "polarity_interaction_response_seconds",
+    "Time from an interaction being created to its command completing",
+    ["command"],
+)
+
+
+# Report the 429s hikari retries in the current task are also counted in,
+# anything with a rate_limited count, eg. a delivery.DeliveryReport
+rate_limit_report: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar(
+    "rate_limit_report", default=None
+)
+
+
+class _HikariRateLimits(logging.Handler):
+    # hikari waits out most 429s and retries without raising, all that is
+    # left of them is a warning or error it logs. Matched on the wording of
+    # hikari's messages, which is pinned in requirements.txt
+    def emit(self, record: logging.LogRecord) -> None:
+        if isinstance(record.msg, str) and record.msg.startswith("rate limited on"):
+            rate_limited.inc(outcome="retried")
+            report = rate_limit_report.get()
+            if report is not None:
+                report.rate_limited += 1
+
+
+def watch_rate_limits() -> None:
+    """Count the 429s hikari retries by itself in rate_limited
+
+    Their log records are only made with LOG_LEVEL at WARNING or below"""
+    logger = logging.getLogger("hikari.rest")
+    if not any(isinstance(handler, _HikariRateLimits) for handler in logger.handlers):
+        logger.addHandler(_HikariRateLimits())
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def _record_interaction_response(event: lightbulb.CommandCompletionEvent):
+    interaction = getattr(event.context, "interaction", None)
+    if interaction is None:
+        return
+    elapsed = dt.datetime.now(tz=dt.timezone.utc) - interaction.created_at
+    interaction_response.observe(
+        elapsed.total_seconds(), command=event.command.qualname
+    )
+
+
+def arm(bot: lightbulb.BotApp, app: web.Application) -> None:
+    watch_rate_limits()
+    app.add_routes([web.get("/metrics", metrics_handler)])
+    bot.listen(lightbulb.CommandCompletionEvent)(_record_interaction_response)
@@ -0,0 +1,102 @@
+# Pre-flight checks on announcements before they are sent to every channel
+# A broken infographic link that makes it out has to be fixed with a
+# correction pass over every channel, so announcements whose image isn't
+# reachable or isn't an image are held back and admins are alerted. An admin
+# can then release or discard the held announcement with /kyber preflight
+
+import asyncio
+import logging
+from typing import Dict, Optional
+
+import aiohttp
+import hikari
+
+from . import cfg, rest_lanes
+from .rest_lanes import Lane
+from .schemas import Feed
+
+# Held announcements, resolved with whether they may go out
+_held: Dict[Feed, asyncio.Future] = {}
+
+
+async def check_image(url: str) -> Optional[str]:
+    """Returns what is wrong with url as an embed image, None if nothing"""
+    timeout = aiohttp.ClientTimeout(total=cfg.preflight_timeout)
+    try:
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.head(url, allow_redirects=True) as resp:
+                status = resp.status
+                content_type = resp.headers.get("Content-Type", "")
+            if status in [403, 405]:
+                # Some hosts don't answer HEAD requests, the headers of
+                # a GET are enough so the body isn't read
+                async with session.get(url, allow_redirects=True) as resp:
+                    status = resp.status
+                    content_type = resp.headers.get("Content-Type", "")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return "could not be fetched ({})".format(e.__class__.__name__)
+    if status >= 400:
+        return "returned HTTP {}".format(status)
+    if not content_type.startswith("image/"):
+        return 'is not an image (content type "{}")'.format(content_type)
+    return None
+
+
+async def preflight(bot: hikari.GatewayBot, feed: Feed, embed: hikari.Embed) -> bool:
+    """Check an announcement before fan-out, returns whether it may go out
+
+    Announcements that fail are held until an admin releases or discards
+    them, or are discarded after cfg.preflight_hold_minutes"""
+    if not cfg.preflight_enabled or embed.image is None:
+        return True
+    url = embed.image.url
+    problem = await check_image(url)
+    if problem is None:
+        return True
+
+    if feed in _held:
+        # Only one announcement per feed is held at a time, so /kyber
+        # preflight always decides the one that is waiting
+        alert = (
+            "{} announcement discarded, its image <{}> {} and an earlier one "
+            + "is still held"
+        ).format(feed.label, url, problem)
+        logging.error(alert)
+        await _alert_admins(bot, alert)
+        return False
+
+    alert = "{} announcement held, its image <{}> {}".format(feed.label, url, problem)
+    logging.error(alert)
+    decision = asyncio.get_running_loop().create_future()
+    _held[feed] = decision
+    try:
+        await _alert_admins(
+            bot, alert + "\nUse `/kyber preflight` to release or discard it"
+        )
+        return await asyncio.wait_for(decision, cfg.preflight_hold_minutes * 60)
+    except asyncio.TimeoutError:
+        logging.error(
+            "{} announcement discarded, it was not released in time".format(feed.label)
+        )
+        return False
+    finally:
+        _held.pop(feed, None)
+
+
+def decide(feed: Feed, release: bool) -> bool:
+    """Release or discard a held announcement, returns whether one was held"""
+    decision = _held.get(feed)
+    if decision is None or decision.done():
+        return False
+    decision.set_result(release)
+    return True
+
+
+async def _alert_admins(bot: hikari.GatewayBot, alert: str) -> None:
+    if cfg.alerts_channel_id is None:
+        return
+    try:
+        await rest_lanes.acquire(Lane.ADMIN)
+        await bot.rest.create_message(cfg.alerts_channel_id, alert)
+    except hikari.HTTPError:
+        logging.exception("Could not post alert to admins")
@@ -0,0 +1,106 @@
+# On demand profiling of the running bot
+# cProfile is enabled on the event loop's thread, so it sees every
+# coroutine run while it is on. A session either lasts a set number of
+# seconds (/kyber debug profile) or wraps the next announcement run. The
+# stats are dumped to cfg.profile_dir for snakeviz/pstats, and a short
+# summary of the functions that took the most time is returned.
+
+import asyncio
+import contextlib
+import cProfile
+import datetime as dt
+import logging
+import os
+import pstats
+from typing import Optional
+
+from . import cfg
+
+# Whether the next announcement run should be profiled
+profile_next_announcement = False
+_active = False
+
+
+class ProfileResult:
+    def __init__(self) -> None:
+        self.path: Optional[str] = None
+        self.summary = ""
+
+
+def is_active() -> bool:
+    return _active
+
+
+class ProfilingActiveError(RuntimeError):
+    pass
+
+
+@contextlib.asynccontextmanager
+async def _profiling(label: str):
+    global _active
+    if _active:
+        raise ProfilingActiveError("A profiling session is already running")
+    _active = True
+    profiler = cProfile.Profile()
+    result = ProfileResult()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        _active = False
+        result.path = os.path.join(
+            cfg.profile_dir,
+            "{}-{}.prof".format(label, dt.datetime.utcnow().strftime("%Y%m%d-%H%M%S")),
+        )
+        # Writing and sorting the stats of a long session takes a while,
+        # keep it off the event loop
+        result.summary = await asyncio.get_running_loop().run_in_executor(
+            None, _save, profiler, result.path
+        )
+        logging.info(
+            "Profile saved to {}, top functions:\n{}".format(
+                result.path, result.summary
+            )
+        )
+
+
+def _save(profiler: cProfile.Profile, path: str) -> str:
+    os.makedirs(cfg.profile_dir, exist_ok=True)
+    profiler.dump_stats(path)
+    return _summarize(pstats.Stats(profiler), cfg.profile_top)
+
+
+def _summarize(stats: pstats.Stats, top: int) -> str:
+    # Sorted by time spent in the function itself, cumulative times of
+    # coroutines are dominated by the event loop and say little
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+    lines = ["    own    total    calls  function"]
+    for (filename, line, function), (_, calls, own, total, _) in rows[:top]:
+        lines.append(
+            "{:7.3f}s {:7.3f}s {:8} {}:{}({})".format(
+                own, total, calls, os.path.basename(filename), line, function
+            )
+        )
+    return "\n".join(lines)
+
+
+async def profile_for(seconds: float) -> ProfileResult:
+    """Profile everything the bot does for the next seconds
+
+    Raises ProfilingActiveError if a session is already running"""
+    async with _profiling("live") as result:
+        await asyncio.sleep(seconds)
+    return result
+
+
+@contextlib.asynccontextmanager
+async def announcement(name: str):
+    """Profile the enclosed announcement run if one was asked for"""
+    global profile_next_announcement
+    if not profile_next_announcement or _active:
+        yield
+        return
+    profile_next_announcement = False
+    async with _profiling(name.lower().replace(" ", "_")):
+        yield
@@ -0,0 +1,76 @@
+# Rehosting of announcement images on Discord's CDN
+# Embeds that point at the kyber3000.com redirect target make Discord's
+# media proxy fetch the image from that origin for every guild and region
+# right at reset. The infographic is instead uploaded once per period as an
+# attachment to cfg.image_rehost_channel_id and every embed uses the
+# attachment's CDN URL, which is already cached by the time it is seen.
+
+import asyncio
+import logging
+import posixpath
+import time
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+import hikari
+
+from . import cfg, rest_lanes
+from .rest_lanes import Lane
+from .schemas import Feed
+
+# Latest upload for each feed, as (origin url, CDN url, monotonic upload time)
+# A new infographic url is uploaded again, as is one whose upload is older
+# than cfg.image_rehost_ttl, since Discord's signed CDN urls expire
+_rehosted: Dict[Feed, Tuple[str, str, float]] = {}
+
+
+def _filename(feed: Feed, url: str, content_type: str) -> str:
+    name = posixpath.basename(urlparse(url).path)
+    if "." in name:
+        return name
+    extension = content_type.partition("/")[2].partition(";")[0] or "png"
+    return "{}.{}".format(feed.name.lower(), extension)
+
+
+async def rehost_image(
+    bot: hikari.GatewayBot, feed: Feed, embed: hikari.Embed
+) -> hikari.Embed:
+    """Point the image of embed at a copy on Discord's CDN
+
+    The embed is left as is if rehosting is disabled or fails"""
+    if cfg.image_rehost_channel_id is None or embed.image is None:
+        return embed
+    url = embed.image.url
+
+    cached = _rehosted.get(feed)
+    if (
+        cached is not None
+        and cached[0] == url
+        and time.monotonic() - cached[2] < cfg.image_rehost_ttl
+    ):
+        return embed.set_image(cached[1])
+
+    try:
+        timeout = aiohttp.ClientTimeout(total=cfg.preflight_timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                content_type = resp.headers.get("Content-Type", "")
+                data = await resp.read()
+        await rest_lanes.acquire(Lane.ADMIN)
+        msg = await bot.rest.create_message(
+            cfg.image_rehost_channel_id,
+            "{} infographic from <{}>".format(feed.label, url),
+            attachment=hikari.Bytes(data, _filename(feed, url, content_type)),
+        )
+        cdn_url = msg.attachments[0].url
+    except (aiohttp.ClientError, asyncio.TimeoutError, hikari.HTTPError, IndexError):
+        logging.exception(
+            "Could not rehost {} image, embedding it from the origin".format(feed.label)
+        )
+        return embed
+
+    logging.info("Rehosted {} image at {}".format(feed.label, cdn_url))
+    _rehosted[feed] = (url, cdn_url, time.monotonic())
+    return embed.set_image(cdn_url)
@@ -0,0 +1,96 @@
+# Priority lanes for the bot's REST traffic
+# Discord gives a bot token a single global request budget. During
+# announcement fan-out thousands of sends queue up for it inside hikari and
+# admin commands end up waiting behind them. Requests made with the bot
+# token are paced here instead. Every lane is guaranteed its share of the
+# rate, and may borrow what the other lanes leave unused, so bulk fan-out
+# uses the whole budget when nothing else is going on but can't starve
+# admin traffic.
+# Interaction responses are sent to the interaction's webhook, which isn't
+# counted against the global budget, so they aren't paced.
+
+import asyncio
+import enum
+import time
+from typing import Dict
+
+from . import cfg
+
+
+class Lane(enum.IntEnum):
+    # Admin commands and the requests they make, eg. command syncs
+    ADMIN = 0
+    # Fan-out to subscribed channels
+    BULK = 1
+
+
+class _Bucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        # Allow up to a second's worth of requests in a burst
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self._last_refill = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+
+    def wait(self) -> float:
+        """Seconds until a token is available, 0 if one is now"""
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate else 1.0
+
+
+class LaneLimiter:
+    def __init__(self, rate: float, shares: Dict[Lane, float]):
+        # Requests per second across all lanes
+        self.rate = rate
+        # Lane -> share of the rate it is guaranteed
+        self.shares = shares
+        self._global = _Bucket(rate)
+        self._lanes = {lane: _Bucket(rate * share) for lane, share in shares.items()}
+        self._waiting: Dict[Lane, int] = {lane: 0 for lane in Lane}
+
+    def _entitled(self, lane: Lane) -> bool:
+        # Whether lane is waiting and has some of its own share left
+        return self._waiting[lane] > 0 and self._lanes[lane].wait() == 0
+
+    async def acquire(self, lane: Lane) -> None:
+        """Wait until a request may be made in lane"""
+        self._waiting[lane] += 1
+        own = self._lanes[lane]
+        try:
+            while True:
+                wait = self._global.wait()
+                if wait == 0:
+                    if own.wait() == 0:
+                        own.tokens -= 1
+                        break
+                    # Out of its own share, borrow unless another lane
+                    # is waiting on the share it is owed
+                    if not any(
+                        self._entitled(other) for other in self._lanes if other != lane
+                    ):
+                        break
+                    wait = min(own.wait(), 1 / self.rate)
+                await asyncio.sleep(wait)
+            self._global.tokens -= 1
+        finally:
+            self._waiting[lane] -= 1
+
+    def waiting(self, lane: Lane) -> int:
+        return self._waiting[lane]
+
+
+limiter = LaneLimiter(
+    cfg.rest_global_rate,
+    {Lane.ADMIN: cfg.rest_admin_share, Lane.BULK: 1 - cfg.rest_admin_share},
+)
+
+
+async def acquire(lane: Lane) -> None:
+    await limiter.acquire(lane)
@@ -1,13 +1,26 @@
 import asyncio
 import datetime as dt
+import enum
 
 import aiohttp
-from sqlalchemy import BigInteger, Boolean, DateTime, Integer, String
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Boolean,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    or_,
+    text,
+)
 from sqlalchemy.orm import declarative_mixin, declared_attr
 from sqlalchemy.sql.schema import Column
 
 from . import cfg
-from .utils import Base, db_engine, db_session
+from .utils import Base, db_session
 
 
 @declarative_mixin
@@ -22,6 +35,8 @@ class BasePostSettings:
     autoannounce_enabled = Column(
         "autoannounce_enabled", Boolean, default=True, server_default="t"
     )
+    # Last post in the feed's announcement channel, see cfg.announce_channel_ids
+    announce_msg_id = Column("announce_msg_id", BigInteger)
 
     def __init__(self, id, autoannounce_enabled=True):
         self.id = id
@@ -91,32 +106,158 @@ class XurPostSettings(BasePostSettings, Base):
                         await asyncio.sleep(check_interval)
 
 
-@declarative_mixin
-class BaseChannelRecord:
-    @declared_attr
-    def __tablename__(cls):
-        return cls.__name__.lower()
+class Feed(enum.IntFlag):
+    # Announcement feeds a channel can subscribe to
+    # Values are bits in AutopostSubscription.feeds
+    LOST_SECTOR = 1
+    XUR = 2
+
+    @property
+    def label(self) -> str:
+        return self.name.replace("_", " ").title()
+
+    @property
+    def settings_table(self):
+        return {
+            Feed.LOST_SECTOR: LostSectorPostSettings,
+            Feed.XUR: XurPostSettings,
+        }[self]
+
+    @property
+    def announce_channel_id(self):
+        return cfg.announce_channel_ids.get(self.name.lower())
+
+    @property
+    def msg_id_column(self) -> str:
+        # Name of the AutopostSubscription column holding the id of
+        # the last message posted for this feed
+        return self.name.lower() + "_msg_id"
 
+
+class AutopostSubscription(Base):
+    __tablename__ = "autopostsubscription"
     __mapper_args__ = {"eager_defaults": True}
+    # Only channels subscribed to at least one feed are indexed
+    # This keeps announcement scans to the channels that matter
+    __table_args__ = (
+        Index(
+            "ix_autopostsubscription_feeds",
+            "feeds",
+            postgresql_where=text("feeds != 0"),
+        ),
+    )
 
+    # Channel id
     id = Column("id", BigInteger, primary_key=True)
     # Note: if server_id is -1 then this is a dm channel
     server_id = Column("server_id", BigInteger)
-    last_msg_id = Column("last_msg_id", BigInteger)
-    enabled = Column("enabled", Boolean)
+    # Bitmask of Feed values this channel is subscribed to
+    feeds = Column("feeds", Integer, nullable=False, default=0, server_default="0")
+    lost_sector_msg_id = Column("lost_sector_msg_id", BigInteger)
+    xur_msg_id = Column("xur_msg_id", BigInteger)
+    # Webhook to deliver through, if webhook delivery is enabled
+    webhook_id = Column("webhook_id", BigInteger)
+    webhook_token = Column("webhook_token", String)
+    # Consecutive runs in which delivery failed after all retries
+    failure_count = Column(
+        "failure_count", Integer, nullable=False, default=0, server_default="0"
+    )
+    # UTC time until which the channel is skipped by deliveries
+    quarantined_until = Column("quarantined_until", DateTime)
 
-    def __init__(self, id: int, server_id: int, enabled: bool):
+    def __init__(self, id: int, server_id: int, feeds: Feed = Feed(0)):
         self.id = id
         self.server_id = server_id
-        self.enabled = enabled
+        self.feeds = int(feeds)
+        self.failure_count = 0
 
+    @classmethod
+    def subscribed_to(cls, feeds: Feed):
+        """Where clause selecting channels subscribed to any of feeds"""
+        return (cls.feeds != 0) & (cls.feeds.op("&")(int(feeds)) != 0)
 
-class LostSectorAutopostChannel(BaseChannelRecord, Base):
-    pass
+    @classmethod
+    def not_quarantined(cls):
+        """Where clause selecting channels that aren't quarantined"""
+        return or_(
+            cls.quarantined_until == None,
+            cls.quarantined_until <= dt.datetime.utcnow(),
+        )
 
 
-class XurAutopostChannel(BaseChannelRecord, Base):
-    pass
+class DeliveryBatch(Base):
+    # Feeds to deliver, queued by the bot for the delivery worker
+    __tablename__ = "deliverybatch"
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column("id", Integer, primary_key=True)
+    created_at = Column("created_at", DateTime, nullable=False)
+    # List of {"feed": Feed value, "embed": serialized hikari.Embed}
+    embeds = Column("embeds", JSON, nullable=False)
+    # Totals of the run so far, added to by the workers as they finish jobs
+    # and saved as a DeliveryRun once the batch's last job is done
+    channels = Column("channels", Integer, nullable=False, server_default="0")
+    succeeded = Column("succeeded", Integer, nullable=False, server_default="0")
+    permanent_failures = Column(
+        "permanent_failures", Integer, nullable=False, server_default="0"
+    )
+    transient_failures = Column(
+        "transient_failures", Integer, nullable=False, server_default="0"
+    )
+    rate_limited = Column("rate_limited", Integer, nullable=False, server_default="0")
+    # Seconds taken by each successful delivery
+    send_latencies = Column(
+        "send_latencies", JSON, nullable=False, server_default=text("'[]'")
+    )
+
+    def __init__(self, embeds: list):
+        self.embeds = embeds
+        self.created_at = dt.datetime.utcnow()
+
+
+class DeliveryJob(Base):
+    # Delivery of a batch to one channel, taken by delivery workers with
+    # SELECT ... FOR UPDATE SKIP LOCKED so that workers never share a job
+    __tablename__ = "deliveryjob"
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column("id", BigInteger, primary_key=True)
+    batch_id = Column(
+        "batch_id",
+        Integer,
+        ForeignKey("deliverybatch.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    channel_id = Column("channel_id", BigInteger, nullable=False)
+    # Feeds of the batch still to be delivered to the channel
+    feeds = Column("feeds", Integer, nullable=False)
+    attempts = Column("attempts", Integer, nullable=False, server_default="0")
+    # UTC time after which the job may be taken, pushed back on retries
+    # and while a worker holds the job
+    available_at = Column(
+        "available_at",
+        DateTime,
+        nullable=False,
+        index=True,
+        server_default=text("(now() at time zone 'utc')"),
+    )
+
+
+class DeliveryRun(Base):
+    # Report of one announcement run, see delivery.DeliveryReport
+    __tablename__ = "deliveryrun"
+    __mapper_args__ = {"eager_defaults": True}
+    id = Column("id", Integer, primary_key=True)
+    started_at = Column("started_at", DateTime, nullable=False, index=True)
+    feeds = Column("feeds", Integer, nullable=False)
+    channels = Column("channels", Integer, nullable=False)
+    succeeded = Column("succeeded", Integer, nullable=False)
+    permanent_failures = Column("permanent_failures", Integer, nullable=False)
+    transient_failures = Column("transient_failures", Integer, nullable=False)
+    rate_limited = Column("rate_limited", Integer, nullable=False)
+    # Send latency percentiles and total run time, in seconds
+    send_p50 = Column("send_p50", Float)
+    send_p95 = Column("send_p95", Float)
+    send_p99 = Column("send_p99", Float)
+    wall_time = Column("wall_time", Float, nullable=False)
 
 
 class Commands(Base):
@@ -0,0 +1,196 @@
+# Tracing of where the time goes in announcement runs
+# Spans nest through a context variable, so a span opened inside another,
+# including in tasks started from within it, becomes its child. Timings use
+# the monotonic clock. Once the outermost span of a trace finishes, the whole
+# trace is written to cfg.trace_file as JSON lines and/or posted to an OTLP
+# collector at cfg.otlp_endpoint, if either is set. With neither set, spans
+# only time their block and log how long top level ones took.
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import secrets
+import time
+from typing import Any, Dict, List, Optional, Set, Union
+
+import aiohttp
+
+from . import cfg
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar(
+    "current_span", default=None
+)
+# Keeps running exports from being garbage collected
+_exports: Set[asyncio.Future] = set()
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.error: Optional[str] = None
+        # Wall clock start for exporting, the duration comes from the
+        # monotonic clock so clock adjustments don't skew it
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+        # Finished spans of the whole trace, shared with the root span
+        self._trace: List[Span] = parent._trace if parent else []
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    @property
+    def end_ns(self) -> int:
+        return self.start_ns + int(self.duration * 1e9)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _UntracedSpan:
+    """Stands in for a span while tracing is off"""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set_attributes(self, **attributes) -> None:
+        pass
+
+
+def enabled() -> bool:
+    return cfg.trace_file is not None or cfg.otlp_endpoint is not None
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Time the enclosed block as a span named name"""
+    parent = _current_span.get()
+    traced = enabled()
+    # Untraced spans are only timed, and logged if they are top level
+    span_ = Span(name, parent, attributes) if traced else _UntracedSpan()
+    token = _current_span.set(span_)
+    if parent is None:
+        logging.info("{} started".format(name))
+    try:
+        yield span_
+    except BaseException as e:
+        span_.error = repr(e)
+        raise
+    finally:
+        span_.duration = time.perf_counter() - span_._start
+        _current_span.reset(token)
+        # Only top level operations are worth a line in the log
+        if parent is None or traced:
+            logging.log(
+                logging.INFO if parent is None else logging.DEBUG,
+                "{} finished in {:.3f}s".format(name, span_.duration),
+            )
+        if traced:
+            span_._trace.append(span_)
+            if parent is None:
+                _export(span_._trace)
+
+
+def current_span() -> Union[Span, _UntracedSpan]:
+    """The innermost open span, a stand in if there is none"""
+    return _current_span.get() or _UntracedSpan()
+
+
+def _export(trace: List[Span]) -> None:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Outside the event loop, eg. in a benchmark
+        if cfg.trace_file is not None:
+            _write_json_lines(trace)
+        return
+    if cfg.trace_file is not None:
+        _track(loop.run_in_executor(None, _write_json_lines, trace))
+    if cfg.otlp_endpoint is not None:
+        _track(loop.create_task(_post_otlp(trace)))
+
+
+def _track(future: asyncio.Future) -> None:
+    _exports.add(future)
+    future.add_done_callback(_exports.discard)
+
+
+def _write_json_lines(trace: List[Span]) -> None:
+    with open(cfg.trace_file, "a") as f:
+        for span_ in trace:
+            f.write(json.dumps(span_.to_dict(), default=str) + "\n")
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span_: Span) -> dict:
+    otlp_span = {
+        "traceId": span_.trace_id,
+        "spanId": span_.span_id,
+        "name": span_.name,
+        # Internal
+        "kind": 1,
+        "startTimeUnixNano": str(span_.start_ns),
+        "endTimeUnixNano": str(span_.end_ns),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in span_.attributes.items()
+        ],
+        # Error or unset
+        "status": {"code": 2, "message": span_.error} if span_.error else {},
+    }
+    if span_.parent is not None:
+        otlp_span["parentSpanId"] = span_.parent.span_id
+    return otlp_span
+
+
+async def _post_otlp(trace: List[Span]) -> None:
+    # OTLP/HTTP with a JSON body, as taken by the OpenTelemetry collector
+    body = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": "polarity"}}
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "polarity"},
+                        "spans": [_otlp_span(span_) for span_ in trace],
+                    }
+                ],
+            }
+        ]
+    }
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(cfg.otlp_endpoint, json=body) as resp:
+                resp.raise_for_status()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logging.exception("Could not export trace to {}".format(cfg.otlp_endpoint))
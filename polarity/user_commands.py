@@ -1,27 +1,43 @@
 # End user facing command implementations for the bot
 
+import asyncio
 import datetime as dt
+import functools
 import logging
+import time
 from calendar import month_name as month
+from typing import Dict, List, Optional, Tuple
 
-import aiohttp
 import hikari
 import lightbulb
 from pytz import utc
 from sector_accounting import Rotation
 from sqlalchemy.sql.expression import delete, select
 
-from . import cfg
+from . import cfg, logs, metrics, rest_lanes
+from .command_sync import get_syncer
+from .rest_lanes import Lane
 from .utils import (
     RefreshCmdListEvent,
     url_regex,
     weekend_period,
     follow_link_single_step,
+    http_session,
+    redirect_cache,
 )
 from .schemas import db_session
 from .schemas import Commands
 
+# Custom command name -> lightbulb command, unused in dispatcher mode
 command_registry = {}
+# Custom command name -> Commands record, for lookups without the db
+command_index: Dict[str, Commands] = {}
+
+
+async def _command_names(session) -> List[str]:
+    """Names of the custom commands in the db"""
+    additional_commands = (await session.execute(select(Commands))).fetchall()
+    return [command[0].name for command in additional_commands]
 
 
 @lightbulb.add_checks(lightbulb.checks.has_roles(cfg.admin_role))
@@ -45,13 +61,10 @@ async def add_command(ctx: lightbulb.Context) -> None:
 
     async with db_session() as session:
         async with session.begin():
-            additional_commands = (await session.execute(select(Commands))).fetchall()
-            additional_commands = (
-                [] if additional_commands is None else additional_commands
-            )
-            additional_commands = [command[0].name for command in additional_commands]
+            additional_commands = await _command_names(session)
             # ToDo: Update hardcoded command names
-            if name in ["add", "edit", "delete"] + additional_commands:
+            reserved = ["add", "edit", "delete", cfg.custom_commands_dispatcher_name]
+            if name in reserved + additional_commands:
                 await ctx.respond("A command with that name already exists")
                 return
 
@@ -62,10 +75,10 @@ async def add_command(ctx: lightbulb.Context) -> None:
             )
             session.add(command)
 
-            command_registry[command.name] = db_command_to_lb_user_command(command)
-            bot.command(command_registry[command.name])
+            slash_command = _register_user_command(bot, command)
             logging.info(command.name + " command registered")
-            RefreshCmdListEvent(bot).dispatch()
+            if slash_command is not None:
+                RefreshCmdListEvent(bot, upsert=[slash_command]).dispatch()
 
     await ctx.respond("Command added")
 
@@ -75,10 +88,8 @@ async def add_command(ctx: lightbulb.Context) -> None:
     "name",
     "Name of the command to delete",
     type=str,
-    # Note: This does not work at the start since command_registry
-    # isn't populated until the bot starts
-    # This is left in in case we modify command_registry in the future
-    choices=[cmd for cmd in command_registry.keys()],
+    # Served from command_registry, see command_name_autocomplete
+    autocomplete=True,
 )
 @lightbulb.command(
     "delete",
@@ -92,17 +103,15 @@ async def del_command(ctx: lightbulb.Context) -> None:
     name = ctx.options.name.lower()
 
     async with db_session() as session:
-        try:
-            command_to_delete = command_registry.pop(name)
-        except KeyError:
+        if name not in command_index:
             await ctx.respond("No such command found")
         else:
             async with session.begin():
                 await session.execute(delete(Commands).where(Commands.name == name))
-                bot.remove_command(command_to_delete)
+                slash_command = _unregister_user_command(bot, name)
                 await ctx.respond("{} command deleted".format(name))
-    # Trigger a refresh of the choices in the delete command
-    RefreshCmdListEvent(bot).dispatch()
+            if slash_command is not None:
+                RefreshCmdListEvent(bot, delete=[slash_command]).dispatch()
 
 
 @lightbulb.add_checks(lightbulb.checks.has_roles(cfg.admin_role))
@@ -128,10 +137,8 @@ async def del_command(ctx: lightbulb.Context) -> None:
     "name",
     "Name of the command to edit",
     type=str,
-    # Note: This does not work at the start since command_registry
-    # isn't populated until the bot starts
-    # This is left in in case we modify command_registry in the future
-    choices=[cmd for cmd in command_registry.keys()],
+    # Served from command_registry, see command_name_autocomplete
+    autocomplete=True,
 )
 @lightbulb.command(
     "edit",
@@ -144,11 +151,10 @@ async def edit_command(ctx: lightbulb.Context):
     bot = ctx.bot
     async with db_session() as session:
         async with session.begin():
-            command: Commands = (
-                await session.execute(
-                    select(Commands).where(Commands.name == ctx.options.name.lower())
-                )
-            ).fetchone()[0]
+            command: Commands = await session.get(Commands, ctx.options.name.lower())
+        if command is None:
+            await ctx.respond("No such command found")
+            return
 
         if (
             ctx.options.new_name in [None, ""]
@@ -165,6 +171,8 @@ async def edit_command(ctx: lightbulb.Context):
                 )
             )
         else:
+            # Commands to update on discord's side
+            upsert, delete = [], []
             if ctx.options.new_name not in [None, ""]:
                 async with session.begin():
                     old_name = command.name
@@ -176,14 +184,14 @@ async def edit_command(ctx: lightbulb.Context):
                     # Need to delete and readd the command instead
                     # -x-x-x-x-
                     # Remove and unregister the old command
-                    bot.remove_command(command_registry.pop(old_name))
+                    delete.append(_unregister_user_command(bot, old_name))
                     # Register new command with bot and registry dict
-                    command_registry[new_name] = db_command_to_lb_user_command(command)
-                    bot.command(command_registry[new_name])
+                    upsert.append(_register_user_command(bot, command))
             if ctx.options.new_response not in [None, ""]:
                 async with session.begin():
                     command.response = ctx.options.new_response
                     session.add(command)
+                    command_index[command.name] = command
             if ctx.options.new_description not in [None, ""]:
                 async with session.begin():
                     command.description = ctx.options.new_description
@@ -193,22 +201,16 @@ async def edit_command(ctx: lightbulb.Context):
                     #     ctx.options.name
                     # ).description = command.description
                     # Need to delete and readd the command instead
-                    bot.remove_command(command_registry.pop(command.name))
-                    command_registry[command.name] = db_command_to_lb_user_command(
-                        command
-                    )
-                    bot.command(command_registry[command.name])
-
-            if ctx.options.new_description not in [
-                None,
-                "",
-            ] or ctx.options.new_name not in [
-                None,
-                "",
-            ]:
-                # If either the description or name of a command is changed
-                # we will need to have discord update its commands server side
-                RefreshCmdListEvent(bot).dispatch()
+                    _unregister_user_command(bot, command.name)
+                    upsert.append(_register_user_command(bot, command))
+
+            # If either the description or name of a command is changed
+            # we will need to have discord update its commands server side
+            # Nothing needs updating in dispatcher mode
+            upsert = [cmd for cmd in upsert if cmd is not None]
+            delete = [cmd for cmd in delete if cmd is not None]
+            if upsert or delete:
+                RefreshCmdListEvent(bot, upsert=upsert, delete=delete).dispatch()
 
             await ctx.respond("Command updated")
 
@@ -216,34 +218,72 @@ async def edit_command(ctx: lightbulb.Context):
 @lightbulb.command("lstoday", "Find out about today's lost sector", auto_defer=True)
 @lightbulb.implements(lightbulb.SlashCommand)
 async def ls_command(ctx: lightbulb.Context):
-    await ctx.respond(embed=await get_lost_sector_text())
+    embed = await get_lost_sector_text()
+    await ctx.respond(embed=embed)
+
+
+@lightbulb.option(
+    "name",
+    "Name of the post",
+    type=str,
+    # Served from command_index, see command_name_autocomplete
+    autocomplete=True,
+)
+@lightbulb.command(
+    cfg.custom_commands_dispatcher_name,
+    "Posts useful info by name",
+    auto_defer=True,
+)
+@lightbulb.implements(lightbulb.SlashCommand)
+async def dispatcher_command(ctx: lightbulb.Context):
+    command = command_index.get(ctx.options.name.lower())
+    if command is None:
+        await ctx.respond("No such command found")
+        return
+    response = await _render_response(command)
+    await ctx.respond(response)
+
+
+@del_command.autocomplete("name")
+@edit_command.autocomplete("name")
+@dispatcher_command.autocomplete("name")
+async def command_name_autocomplete(
+    option: hikari.AutocompleteInteractionOption,
+    interaction: hikari.AutocompleteInteraction,
+) -> List[str]:
+    # Suggest custom commands starting with what has been typed so far
+    # Discord shows at most 25 suggestions
+    prefix = str(option.value or "").lower()
+    return sorted(name for name in command_index if name.startswith(prefix))[:25]
 
 
 async def command_options_updater(event: RefreshCmdListEvent):
-    choices = [cmd for cmd in command_registry.keys()]
-    del_command.options.get("name").choices = choices
-    edit_command.options.get("name").choices = choices
-    if event.sync:
+    if not event.sync:
+        return
+    if not (event.upsert or event.delete):
+        await rest_lanes.acquire(Lane.ADMIN)
         await event.app.sync_application_commands()
+        return
+    # Only sync what changed rather than the whole command tree
+    syncer = get_syncer(event.app)
+    for command in event.delete:
+        syncer.delete(command)
+    for command in event.upsert:
+        syncer.upsert(command)
 
 
 async def register_commands_on_startup(event: hikari.StartingEvent):
-    """Register additional text commands from db."""
+    """Register additional text commands from db, run by warmup.warm_up"""
     logging.info("Registering commands")
     async with db_session() as session:
         async with session.begin():
             command_list = (await session.execute(select(Commands))).fetchall()
-            command_list = [] if command_list is None else command_list
-            command_list = [command[0] for command in command_list]
-            for command in command_list:
-                command_registry[command.name] = db_command_to_lb_user_command(command)
-                event.app.command(command_registry[command.name])
-                logging.info(command.name + " registered")
-
-    # Trigger a refresh of the options in the delete command
-    # Don't sync since the bot has not started yet and
-    # Will sync on its own for startup
-    RefreshCmdListEvent(event.app, sync=False).dispatch()
+    command_list = [] if command_list is None else command_list
+    # Registered once the connection is back in the pool, so it isn't held
+    # while the commands are built
+    for (command,) in command_list:
+        _register_user_command(event.app, command)
+        logging.info(command.name + " registered")
 
 
 async def on_error(event: lightbulb.CommandErrorEvent):
@@ -264,41 +304,62 @@ def register_all(bot: lightbulb.BotApp):
     # Register all commands and listeners with the bot
     for command in [add_command, del_command, edit_command, ls_command]:
         bot.command(command)
+    if cfg.custom_commands_dispatcher:
+        bot.command(dispatcher_command)
 
     for event, handler in [
         (RefreshCmdListEvent, command_options_updater),
-        (hikari.StartingEvent, register_commands_on_startup),
         (lightbulb.CommandErrorEvent, on_error),
     ]:
         bot.listen(event)(handler)
 
 
 async def user_command(ctx: lightbulb.Context):
-    async with db_session() as session:
-        async with session.begin():
-            command = (
-                await session.execute(
-                    select(Commands).where(Commands.name == ctx.command.name)
-                )
-            ).fetchone()[0]
+    response = await _render_response(command_index[ctx.command.name])
+    await ctx.respond(response)
+
+
+async def _render_response(command: Commands) -> str:
     text = command.response.strip()
     # Follow the redirects, check the extension, download only if it is a jgp
     # Above to be implemented
     links = url_regex.findall(text)
     redirected_links = []
     redirected_text = url_regex.sub("{}", text)
-    async with aiohttp.ClientSession() as session:
-        for link in links:
-            async with session.get(link, allow_redirects=False) as response:
-                redirected_links.append(str(response.headers["Location"]))
-                logging.info(
-                    "Replacing link: {} with redirect: {}".format(
-                        link, redirected_links[-1]
-                    )
-                )
-    redirected_text = redirected_text.format(*redirected_links)
-
-    await ctx.respond(redirected_text)
+    for link in links:
+        redirected_links.append(await redirect_cache.resolve(link))
+        logging.info(
+            "Replacing link: {} with redirect: {}".format(link, redirected_links[-1]),
+            extra=logs.aggregate("links replaced"),
+        )
+    return redirected_text.format(*redirected_links)
+
+
+def _register_user_command(
+    bot: lightbulb.BotApp, command: Commands
+) -> Optional[lightbulb.commands.base.Command]:
+    """Make a custom command usable, returns the slash command
+    that needs syncing with discord if there is one"""
+    command_index[command.name] = command
+    if cfg.custom_commands_dispatcher:
+        # Served by the dispatcher command, nothing to register
+        return None
+    command_registry[command.name] = db_command_to_lb_user_command(command)
+    bot.command(command_registry[command.name])
+    return bot.get_slash_command(command.name)
+
+
+def _unregister_user_command(
+    bot: lightbulb.BotApp, name: str
+) -> Optional[lightbulb.commands.base.Command]:
+    """Remove a custom command, returns the slash command
+    that needs removing from discord if there is one"""
+    command_index.pop(name, None)
+    if cfg.custom_commands_dispatcher:
+        return None
+    slash_command = bot.get_slash_command(name)
+    bot.remove_command(command_registry.pop(name))
+    return slash_command
 
 
 def db_command_to_lb_user_command(command: Commands):
@@ -308,20 +369,52 @@ def db_command_to_lb_user_command(command: Commands):
     )
 
 
+class RotationCache:
+    """The lost sector rotation read from Sheets, kept for ttl seconds
+
+    gspread is synchronous, so the sheet is read in a thread rather than
+    on the event loop. Concurrent callers wait on a single read"""
+
+    def __init__(self, ttl: float, buffer: int) -> None:
+        self.ttl = ttl
+        # Minutes past reset the rotation moves on to the next sector
+        self.buffer = buffer
+        # (monotonic time it expires, rotation)
+        self._rotation: Optional[Tuple[float, Rotation]] = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> Rotation:
+        async with self._lock:
+            if self._rotation is not None and self._rotation[0] > time.monotonic():
+                return self._rotation[1]
+            with metrics.sheets_fetch.time():
+                rotation = await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    functools.partial(
+                        Rotation.from_gspread_url,
+                        cfg.sheets_ls_url,
+                        cfg.gsheets_credentials(),
+                        buffer=self.buffer,
+                    ),
+                )
+            self._rotation = (time.monotonic() + self.ttl, rotation)
+            return rotation
+
+
+rotation_cache = RotationCache(cfg.rotation_cache_ttl, buffer=1)
+
+
 async def get_lost_sector_text(date: dt.date = None) -> hikari.Embed:
-    buffer = 1  # Minute
+    buffer = rotation_cache.buffer  # Minutes
     if date is None:
         date = dt.datetime.now(tz=utc) - dt.timedelta(hours=16, minutes=60 - buffer)
     else:
         date = date + dt.timedelta(minutes=buffer)
-    rot = Rotation.from_gspread_url(
-        cfg.sheets_ls_url, cfg.gsheets_credentials, buffer=buffer
-    )()
+    rot = (await rotation_cache.get())()
 
     # Follow the hyperlink to have the newest image embedded
-    async with aiohttp.ClientSession() as session:
-        async with session.get(rot.shortlink_gfx, allow_redirects=False) as response:
-            ls_gfx_url = str(response.headers["Location"])
+    async with http_session().get(rot.shortlink_gfx, allow_redirects=False) as response:
+        ls_gfx_url = str(response.headers["Location"])
 
     format_dict = {
         "month": month[date.month],
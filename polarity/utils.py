@@ -1,33 +1,154 @@
-import contextlib
 import datetime as dt
 import logging
 import re
-from typing import Tuple
+import time
+from typing import Dict, Optional, Sequence, Tuple
 
 import aiohttp
 import hikari
 from pytz import utc
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from . import cfg
+from . import cfg, metrics
 
 url_regex = re.compile(
     "http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
 )
 
 
+class PoolStats:
+    """Live counters for the connection pool of the db engine
+
+    Wait time is measured from the moment a connection is requested
+    from the pool until one is handed out, including the time taken
+    to open a new connection when the pool is allowed to overflow"""
+
+    def __init__(self) -> None:
+        # Number of coroutines currently waiting on a connection
+        self.waiting = 0
+        self.reset()
+
+    def reset(self) -> None:
+        # Only the running totals, waiting follows the coroutines that are
+        # waiting right now and goes back down as they get a connection
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, wait: float, timed_out: bool = False) -> None:
+        self.checkouts += 1
+        self.timeouts += timed_out
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        metrics.db_pool_wait.observe(wait)
+
+    @property
+    def avg_wait(self) -> float:
+        return self.total_wait / self.checkouts if self.checkouts else 0.0
+
+    def snapshot(self) -> dict:
+        pool = get_db_engine().sync_engine.pool
+        return {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "waiting": self.waiting,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait": self.avg_wait,
+            "max_wait": self.max_wait,
+        }
+
+    def __str__(self) -> str:
+        return (
+            "DB pool: {checked_out} checked out, {checked_in} idle, "
+            + "{overflow} overflow (size {size}), {waiting} waiting, "
+            + "{checkouts} checkouts, {timeouts} timeouts, "
+            + "avg wait {avg_wait:.3f}s, max wait {max_wait:.3f}s"
+        ).format(**self.snapshot())
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    # Queue pool that records how long checkouts wait in pool_stats
+    def _do_get(self):
+        pool_stats.waiting += 1
+        start = time.monotonic()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_stats.waiting -= 1
+            pool_stats.record_wait(time.monotonic() - start, timed_out)
+
+
 Base = declarative_base()
-db_engine = create_async_engine(cfg.db_url_async)
-db_session = sessionmaker(db_engine, **cfg.db_session_kwargs)
+# The engine and the http session are made on first use rather than at
+# import, which keeps importing polarity cheap and lets processes that never
+# touch the db or the web skip them entirely
+_db_engine: Optional[AsyncEngine] = None
+_db_sessionmaker: Optional[sessionmaker] = None
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_db_engine() -> AsyncEngine:
+    global _db_engine
+    if _db_engine is None:
+        _db_engine = create_async_engine(
+            cfg.db_url_async, poolclass=InstrumentedPool, **cfg.db_engine_kwargs
+        )
+    return _db_engine
+
+
+def db_session(**kwargs) -> AsyncSession:
+    """A new session on the db engine"""
+    global _db_sessionmaker
+    if _db_sessionmaker is None:
+        _db_sessionmaker = sessionmaker(get_db_engine(), **cfg.db_session_kwargs)
+    return _db_sessionmaker(**kwargs)
+
+
+def http_session() -> aiohttp.ClientSession:
+    """Client session shared by quick lookups, so they reuse connections
+
+    Must be used from the event loop it was first used on"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+
+async def close_http_session() -> None:
+    if _http_session is not None:
+        await _http_session.close()
 
 
 class RefreshCmdListEvent(hikari.Event):
-    def __init__(self, bot: hikari.GatewayBot, sync: bool = True):
+    def __init__(
+        self,
+        bot: hikari.GatewayBot,
+        sync: bool = True,
+        upsert: Sequence = (),
+        delete: Sequence = (),
+    ):
         super().__init__()
-        # Whether to run the sync_application_commands method of the app
+        # Whether to sync commands with discord
         self.bot = bot
         self.sync = sync
+        # Commands that changed, only these are synced if either is given
+        # Otherwise the sync_application_commands method of the app is run
+        self.upsert = upsert
+        self.delete = delete
 
     @property
     def app(self):
@@ -47,22 +168,6 @@ async def _create_or_get(cls, id, **kwargs):
     return instance
 
 
-@contextlib.contextmanager
-def operation_timer(op_name):
-    start_time = dt.datetime.now()
-    logging.info("{name} started".format(name=op_name))
-    yield
-    end_time = dt.datetime.now()
-    time_delta = end_time - start_time
-    minutes = time_delta.seconds // 60
-    seconds = time_delta.seconds % 60
-    logging.info(
-        "{name} finished in {mins} minutes and {secs} seconds".format(
-            name=op_name, mins=minutes, secs=seconds
-        )
-    )
-
-
 def weekend_period(today: dt.datetime = None) -> Tuple[dt.datetime, dt.datetime]:
     if today is None:
         today = dt.datetime.now()
@@ -93,15 +198,39 @@ def day_period(today: dt.datetime = None) -> Tuple[dt.datetime, dt.datetime]:
 
 
 async def follow_link_single_step(url: str) -> str:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, allow_redirects=False) as resp:
-            try:
-                return resp.headers["Location"]
-            except KeyError:
-                # If we can't find the location key, warn and return the
-                # provided url itself
-                logging.warning(
-                    "Could not find redirect for url "
-                    + "{}, returning as is".format(url)
-                )
-                return url
+    async with http_session().get(url, allow_redirects=False) as resp:
+        try:
+            return resp.headers["Location"]
+        except KeyError:
+            # If we can't find the location key, warn and return the
+            # provided url itself
+            logging.warning(
+                "Could not find redirect for url " + "{}, returning as is".format(url)
+            )
+            return url
+
+
+class RedirectCache:
+    """Redirect targets of links, kept for cfg.redirect_cache_ttl seconds
+
+    Custom command responses follow every link they hold on each use,
+    this saves the round trip when the same links are asked for again"""
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        # Link -> (monotonic time it expires, redirect target)
+        self._targets: Dict[str, Tuple[float, str]] = {}
+
+    async def resolve(self, url: str) -> str:
+        now = time.monotonic()
+        cached = self._targets.get(url)
+        if cached is not None and cached[0] > now:
+            metrics.redirect_cache_requests.inc(result="hit")
+            return cached[1]
+        metrics.redirect_cache_requests.inc(result="miss")
+        target = await follow_link_single_step(url)
+        self._targets[url] = (now + self.ttl, target)
+        return target
+
+
+redirect_cache = RedirectCache(cfg.redirect_cache_ttl)
@@ -0,0 +1,53 @@
+# Startup work done while the bot connects to the gateway
+# Registering the custom commands, loading the announcement settings and
+# reading the lost sector rotation all wait on the network, so they are run
+# concurrently at StartingEvent rather than one after another. The settings
+# load also opens the first pool connections before a reset needs them.
+# Each step is traced as a span and its duration kept in phases.
+
+import asyncio
+import logging
+from typing import Dict
+
+import hikari
+
+from . import tracing, user_commands
+from .schemas import LostSectorPostSettings, XurPostSettings
+from .utils import _create_or_get
+
+# Step name -> seconds it took in the last warm up
+phases: Dict[str, float] = {}
+
+
+async def _load_settings() -> None:
+    await asyncio.gather(
+        _create_or_get(LostSectorPostSettings, 0),
+        _create_or_get(XurPostSettings, 0),
+    )
+
+
+async def _phase(name: str, coro) -> None:
+    try:
+        with tracing.span(name) as span:
+            await coro
+    finally:
+        phases[name] = span.duration
+
+
+async def warm_up(event: hikari.StartingEvent) -> None:
+    steps = {
+        "commands": user_commands.register_commands_on_startup(event),
+        "settings": _load_settings(),
+        "rotation": user_commands.rotation_cache.get(),
+    }
+    with tracing.span("Warm up") as span:
+        results = await asyncio.gather(
+            *[_phase(name, coro) for name, coro in steps.items()],
+            return_exceptions=True,
+        )
+    phases["total"] = span.duration
+    # Failures are logged rather than stopping the bot, the settings and
+    # the rotation are loaded again on first use
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logging.error("Warm up of {} failed".format(name), exc_info=result)